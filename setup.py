@@ -29,10 +29,18 @@ setup(
 
     packages=("td6502",),
 
+    extras_require={
+        "numpy" : ("numpy",),
+    },
+
     entry_points={
         "console_scripts" : (
             "td6502=td6502.__main__:dis_main",
             "td6502-analyze=td6502.__main__:ana_main",
+            "td6502-run=td6502.__main__:run_main",
+            "td6502-project=td6502.__main__:project_main",
+            "td6502-server=td6502.__main__:server_main",
+            "td6502-xref=td6502.__main__:xref_main",
         ),
     },
 )
@@ -2,6 +2,12 @@
 
 
 import collections.abc
+import struct
+
+from .decode import DecodedBank
+
+
+__version__ = "0.1.0"
 
 
 class Permission:
@@ -11,7 +17,125 @@ class Permission:
         self.executable = executable
 
 
+class PermissionMap:
+    """アドレスごとの読み/書き/実行パーミッション。
+
+    1アドレスにつき1バイトのフラグ (READABLE | WRITABLE | EXECUTABLE)
+    で保持する。範囲単位の変更は set_range() で行う。
+
+    perms[addr] は Permission 互換のオブジェクトを返すので、個々のア
+    ドレスの属性を直接読み書きすることもできる(遅いが、旧来のプラグ
+    インとの互換性のため)。
+    """
+
+    READABLE   = 1 << 0
+    WRITABLE   = 1 << 1
+    EXECUTABLE = 1 << 2
+
+    def __init__(self, readable=True, writable=True, executable=True):
+        flags = PermissionMap._flags(readable, writable, executable)
+        self.flags = bytearray((flags,)) * 0x10000
+
+    def readable(self, addr):
+        return bool(self.flags[addr] & PermissionMap.READABLE)
+
+    def writable(self, addr):
+        return bool(self.flags[addr] & PermissionMap.WRITABLE)
+
+    def executable(self, addr):
+        return bool(self.flags[addr] & PermissionMap.EXECUTABLE)
+
+    def set(self, addr, *, readable=None, writable=None, executable=None):
+        """addr のパーミッションを変更する。None を指定した属性は変更しない。"""
+        if not 0 <= addr <= 0xFFFF: raise ValueError("addr out of range")
+
+        set_, clr = PermissionMap._masks(readable, writable, executable)
+        self.flags[addr] = (self.flags[addr] & ~clr) | set_
+
+    def set_range(self, lo, hi, *, step=1, readable=None, writable=None, executable=None):
+        """[lo, hi] の範囲 (step 間隔) のパーミッションを変更する。
+
+        None を指定した属性は変更しない。
+        """
+        if not 0 <= lo <= hi <= 0xFFFF: raise ValueError("addr out of range")
+        if step < 1: raise ValueError("step must be positive")
+
+        set_, clr = PermissionMap._masks(readable, writable, executable)
+        table = bytes(((b & ~clr) | set_) for b in range(0x100))
+
+        self.flags[lo:hi+1:step] = self.flags[lo:hi+1:step].translate(table)
+
+    def count(self, lo, hi, mask):
+        """[lo, hi] の範囲で mask のフラグを全て持つアドレスの数を返す。"""
+        if not 0 <= lo <= hi <= 0xFFFF: raise ValueError("addr out of range")
+
+        table = bytes(int(b & mask == mask) for b in range(0x100))
+        return self.flags[lo:hi+1].translate(table).count(1)
+
+    def __getitem__(self, addr):
+        if not 0 <= addr <= 0xFFFF: raise IndexError()
+        return _PermissionRef(self, addr)
+
+    def __len__(self):
+        return 0x10000
+
+    @staticmethod
+    def _flags(readable, writable, executable):
+        return (PermissionMap.READABLE   if readable   else 0) |\
+               (PermissionMap.WRITABLE   if writable   else 0) |\
+               (PermissionMap.EXECUTABLE if executable else 0)
+
+    @staticmethod
+    def _masks(readable, writable, executable):
+        """(立てるフラグ, 落とすフラグ) を返す。"""
+        def on(value):  return value is not None and bool(value)
+        def off(value): return value is not None and not value
+        set_ = PermissionMap._flags(on(readable),  on(writable),  on(executable))
+        clr  = PermissionMap._flags(off(readable), off(writable), off(executable))
+        return set_, clr
+
+class _PermissionRef:
+    """PermissionMap の1アドレス分を Permission として見せるビュー。"""
+
+    def __init__(self, map_, addr):
+        self._map  = map_
+        self._addr = addr
+
+    @property
+    def readable(self):
+        return self._map.readable(self._addr)
+
+    @readable.setter
+    def readable(self, value):
+        self._map.set(self._addr, readable=value)
+
+    @property
+    def writable(self):
+        return self._map.writable(self._addr)
+
+    @writable.setter
+    def writable(self, value):
+        self._map.set(self._addr, writable=value)
+
+    @property
+    def executable(self):
+        return self._map.executable(self._addr)
+
+    @executable.setter
+    def executable(self, value):
+        self._map.set(self._addr, executable=value)
+
+
 class Bank(collections.abc.Sequence):
+    """org から配置されたバイト列。
+
+    body は bytes の他、mmap や memoryview など buffer protocol をサポー
+    トするものなら何でもよい(コピーせずに参照する)。スライスは
+    memoryview を返す。
+    """
+
+    _U16 = struct.Struct("<H")
+
     def __init__(self, body, org):
         if not body: raise ValueError("body empty")
         if not 0 <= org <= 0xFFFF: raise ValueError("addr out of range")
@@ -19,24 +143,54 @@ class Bank(collections.abc.Sequence):
         self.body = body
         self.org  = org
 
+        self._view    = memoryview(body).cast("B")
+        self._decoded = None
+
     def addr_max(self):
         return self.org + len(self.body) - 1
 
     def addr_contains(self, addr):
         return self.org <= addr <= self.addr_max()
 
+    def decode(self):
+        """全アドレスを命令としてデコードした結果を返す(初回のみ計算)。"""
+        if self._decoded is None:
+            self._decoded = DecodedBank(self)
+        return self._decoded
+
+    def view(self):
+        """body 全体の memoryview を返す。"""
+        return self._view
+
+    def read_u8(self, addr):
+        if not self.addr_contains(addr): raise IndexError()
+        return self._view[addr - self.org]
+
+    def read_u16(self, addr):
+        """addr から 2 バイトをリトルエンディアンで読む。"""
+        if not (self.addr_contains(addr) and self.addr_contains(addr+1)): raise IndexError()
+        return Bank._U16.unpack_from(self._view, addr - self.org)[0]
+
     def __getitem__(self, key):
         if isinstance(key, int):
             if not self.addr_contains(key): raise IndexError()
-            return self.body[key - self.org]
+            return self._view[key - self.org]
         elif isinstance(key, slice):
             start, stop, step = key.start, key.stop, key.step
             if not self.addr_contains(start): raise IndexError()
             if stop is not None and stop > self.addr_max()+1: raise IndexError()
-            return self.body[start-self.org : stop-self.org : step]
+            return self._view[start-self.org : stop-self.org if stop is not None else None : step]
         else:
             raise TypeError()
 
+    def __getstate__(self):
+        # mmap, memoryview は pickle できないので bytes にする(プロセス
+        # プールに渡す場合など)
+        return { "body" : bytes(self._view), "org" : self.org }
+
+    def __setstate__(self, state):
+        self.__init__(state["body"], state["org"])
+
     def __len__(self):
         return len(self.body)
 
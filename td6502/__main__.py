@@ -3,16 +3,26 @@
 
 
 import sys
+import os
+import io
+import mmap
+import json
+import time
 import traceback
 import argparse
+import concurrent.futures
 
-from . import Bank, Permission
+from . import Bank, PermissionMap
 from .op import Op
-from .db import Database, Analysis, DataType
+from .db import Database, Analysis, DataType, ScriptError
 from .ana import Analyzer
-from .dis import MD6502Dis
+from .dis import MD6502Dis, JsonLinesDis, BoundaryIndex
 from .plugin import Plugin
-from . import util
+from .ines import INes, is_ines
+from .xref import Access, access_str, access_parse
+from . import space
+from . import _indexcache
+from . import _anacache
 
 
 class ReadAction(argparse.Action):
@@ -26,27 +36,54 @@ class ReadAction(argparse.Action):
         if values is sys.stdin:
             values = sys.stdin.buffer
 
-        with values as in_:
-            buf = in_.read()
+        setattr(namespace, self.dest, read_input(values))
 
-        setattr(namespace, self.dest, buf)
-
-class DatabaseAction(argparse.Action):
-    def __init__(self, option_strings, dest, nargs=None, **kwargs):
-        if nargs is not None: raise ValueError("nargs not allowed")
-        super().__init__(option_strings, dest, **kwargs)
-
-    def __call__(self, parser, namespace, values, option_string=None):
-        db = Database(0)
-        with values as in_:
-            script = in_.read()
+def read_input(file_):
+    """入力ファイルを読み込んで閉じる。
 
+    通常ファイルはメモリマップして読む(全体をメモリに読み込まない)。
+    """
+    with file_ as in_:
         try:
-            db.apply_script(script)
-        except:
-            parser.error(traceback.format_exc())
-
-        setattr(namespace, self.dest, db)
+            return mmap.mmap(in_.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            return in_.read()
+
+DB_MODES = ("auto", "parse", "exec")
+
+def db_load(parser, path, mode):
+    """プログラムデータベースを読み込む。
+
+    スクリプト形式とバイナリ形式を自動判別する。バイナリ形式はメモリ
+    マップして読むのでファイル名で受け取る。mode はスクリプトの実行方
+    法 (DatabaseScript 参照)。
+    """
+    try:
+        if path == "-":
+            script = sys.stdin.read()
+        else:
+            with open(path, "rb") as in_:
+                head = in_.read(16)
+            if Database.is_binary(head):
+                return Database.load_binary(path)
+            script = None
+    except OSError as e:
+        parser.error("can't open '{}': {}".format(path, e))
+    except ValueError:
+        parser.error(traceback.format_exc())
+
+    db = Database(0)
+    try:
+        if script is None:
+            db.apply_script_file(path, mode)
+        else:
+            db.apply_script(script, mode, path)
+    except ScriptError as e:
+        parser.error(str(e))
+    except:
+        parser.error(traceback.format_exc())
+
+    return db
 
 def addr16(str_):
     value = int(str_, base=0)
@@ -54,6 +91,91 @@ def addr16(str_):
         raise argparse.ArgumentTypeError("invalid address: {}".format(str_))
     return value
 
+def addr_banked(str_):
+    """"BB:AAAA" またはアドレスを (バンク番号 or None, アドレス) にする (space.parse())。"""
+    try:
+        return space.parse(str_)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def input_select_bank(ap, args, numbers):
+    """バンク番号付きアドレスで指定されたバンク (numbers) を --prg-bank とする。
+
+    rom_open() の前に呼ぶ。
+    """
+    numbers = set(n for n in numbers if n is not None)
+    if not numbers: return
+    if len(numbers) > 1: ap.error("addresses in different banks")
+    number = numbers.pop()
+    if args.prg_bank is None:
+        args.prg_bank = number
+    elif args.prg_bank != number:
+        ap.error("address in bank {:02X} but --prg-bank={}".format(number, args.prg_bank))
+
+def input_add_arguments(ap):
+    ap.add_argument("--offset", type=lambda s: int(s, base=0), default=0,
+                    help="offset of the bank in the input file")
+    ap.add_argument("--size", type=lambda s: int(s, base=0),
+                    help="size of the bank (default: to the end of the input file)")
+    ap.add_argument("--prg-bank", type=int, metavar="N",
+                    help="PRG bank number (input is iNES file)")
+
+def rom_open(ap, args):
+    """入力が iNES 形式なら INes を返し、args.prg_bank を確定させる。
+
+    そうでなければ None を返す。--offset, --size が指定されていれば入
+    力ファイルのその範囲のみを使う(この場合 iNES 形式とはみなさない)。
+
+    args.prg_offset に入力ファイル内の PRG ROM の先頭位置(iNES 形式で
+    なければ 0)を設定する(CDL ファイル内のオフセットの計算用)。
+    """
+    args.prg_offset = 0
+
+    if args.offset or args.size is not None:
+        end = len(args._buf) if args.size is None else args.offset + args.size
+        if not 0 <= args.offset <= end <= len(args._buf): ap.error("offset/size out of range")
+        if is_ines(args._buf[:4]):
+            try:
+                args.prg_offset = INes(args._buf).prg_offset
+            except ValueError:
+                pass
+        args._buf = memoryview(args._buf)[args.offset:end]
+        if args.prg_bank is not None: ap.error("--prg-bank (or bank-qualified address) requires an iNES file")
+        return None
+
+    if not is_ines(args._buf[:4]):
+        if args.prg_bank is not None: ap.error("--prg-bank (or bank-qualified address) requires an iNES file")
+        return None
+
+    try:
+        rom = INes(args._buf)
+    except ValueError as e:
+        ap.error("invalid iNES file: {}".format(e))
+
+    if args.prg_bank is None:
+        if rom.bank_count() != 1:
+            ap.error("ROM has {} PRG banks, specify --prg-bank".format(rom.bank_count()))
+        args.prg_bank = 0
+    if not 0 <= args.prg_bank < rom.bank_count():
+        ap.error("PRG bank out of range: {}".format(args.prg_bank))
+
+    return rom
+
+def input_bank(ap, args, rom):
+    """入力ファイル(rom が None でなければその PRG バンク)を Bank にする。"""
+    try:
+        if rom is not None:
+            return rom.bank(args.prg_bank, args.db.org)
+        if not args._buf: ap.error("input file is empty")
+        return Bank(args._buf, args.db.org)
+    except ValueError as e:
+        ap.error(str(e))
+
+def default_org(ap, args, rom):
+    if args.org is not None: return args.org
+    if rom is None: ap.error("origin not specified")
+    return rom.default_org(args.prg_bank)
+
 
 #---------------------------------------------------------------------
 # analyzer
@@ -76,6 +198,28 @@ class PluginAction(argparse.Action):
 
         plugins.append((identifier, args))
 
+# --cdl で追加した cdl_fceux プラグインのオフセット(ana_setup() で確定する)
+CDL_OFFSET_AUTO = None
+
+class CdlAction(argparse.Action):
+    """--cdl=foo.cdl[,aggressive] を cdl_fceux プラグインとして追加する。
+
+    CDL ファイル内のオフセットは入力バンクに合わせて自動で決める(iNES
+    ファイルならバンクの PRG ROM 内オフセット、そうでなければ --offset)。
+    """
+
+    def __init__(self, option_strings, dest, nargs=None, **kwargs):
+        if nargs is not None: raise ValueError("nargs not allowed")
+        super().__init__(option_strings, dest, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        plugins = getattr(namespace, self.dest)
+
+        path_args = values.split(",")
+        if len(path_args) > 2: raise ValueError("cdl format error")
+
+        plugins.append(("cdl_fceux", [path_args[0], CDL_OFFSET_AUTO] + path_args[1:]))
+
 def addr_interrupt(str_):
     if str_.lower() == "auto":
         return ADDR_AUTO
@@ -84,7 +228,7 @@ def addr_interrupt(str_):
 
 def interrupt_fetch(bank, addr):
     if bank.addr_contains(addr) and bank.addr_contains(addr+1):
-        return util.unpack_u(bank[addr:addr+2])
+        return bank.read_u16(addr)
     else:
         return None
 
@@ -94,11 +238,12 @@ def interrupt_register(db, name, addr):
     if db.is_code(addr) and not db.get_label_by_addr(addr):
         db.add_label(name, addr)
 
-def ana_parse_args():
-    ap = argparse.ArgumentParser(description="td6502 analyzer")
+def ana_add_arguments(ap):
     ap.add_argument("_buf", type=argparse.FileType("rb"), action=ReadAction, metavar="INFILE")
-    ap.add_argument("--db", type=argparse.FileType("r"), action=DatabaseAction,
-                    help="program database")
+    ap.add_argument("--db",
+                    help="program database (script or binary)")
+    ap.add_argument("--db-mode", choices=DB_MODES, default="auto",
+                    help='how to run a database script ("parse": no Python code, "exec": full Python, "auto": parse if possible)')
     ap.add_argument("--org", type=addr16,
                     help="origin address")
     ap.add_argument("--nmi", type=addr_interrupt,
@@ -107,21 +252,40 @@ def ana_parse_args():
                     help='RESET address ("auto": use interrupt vector)')
     ap.add_argument("--irq", type=addr_interrupt,
                     help='IRQ address ("auto": use interrupt vector)')
+    input_add_arguments(ap)
     ap.add_argument("--plugin", action=PluginAction, dest="plugins", default=[], metavar="PLUGIN",
                     help="plugin (executed in the given order)")
-
-    args = ap.parse_args()
-
-    if args.db is None:
-        if args.org is None: ap.error("origin not specified")
-        args.db = Database(args.org)
+    ap.add_argument("--cdl", action=CdlAction, dest="plugins", metavar="CDL[,aggressive]",
+                    help="FCEUX CDL file for the whole ROM (the region of the bank is used)")
+    ap.add_argument("--cache-dir", default=os.environ.get("TD6502_CACHE_DIR"),
+                    help="cache analysis results in this directory (default: $TD6502_CACHE_DIR)")
+    ap.add_argument("--no-cache", action="store_true",
+                    help="don't use the analysis cache")
+
+def ana_setup(ap, args):
+    """解析対象のデータベースとバンクを準備する。"""
+    rom = rom_open(ap, args)
+
+    if args.db is not None:
+        args.db = db_load(ap, args.db, args.db_mode)
+    else:
+        args.db = Database(default_org(ap, args, rom))
 
     # --db と --org が両方指定された場合、後者を優先(使う場面はあまりないだろうが…)
     if args.org is not None:
         args.db.org = args.org
 
-    if not args._buf: ap.error("input file is empty")
-    args.bank = Bank(args._buf, args.db.org)
+    args.bank = input_bank(ap, args, rom)
+
+    # --cdl の CDL ファイル内オフセット(PRG ROM 先頭からのオフセット)
+    if rom is not None:
+        cdl_offset = rom.bank_offset(args.prg_bank)
+    else:
+        cdl_offset = args.offset - args.prg_offset
+    for _, plg_args in args.plugins:
+        if len(plg_args) > 1 and plg_args[1] is CDL_OFFSET_AUTO:
+            if cdl_offset < 0: ap.error("--cdl: bank is not in PRG ROM")
+            plg_args[1] = str(cdl_offset)
 
     # 特に初期データベースでの指定がなければ割り込みベクタは全て WORD 指定
     if all(args.db.is_unknown(i) for i in range(0xFFFA, 0xFFFF+1)):
@@ -150,22 +314,62 @@ def ana_parse_args():
     if args.irq is not None:
         interrupt_register(args.db, "IRQ", args.irq)
 
+def ana_parse_args():
+    ap = argparse.ArgumentParser(description="td6502 analyzer")
+    ana_add_arguments(ap)
+    ap.add_argument("--binary", action="store_true",
+                    help="output program database in binary format")
+
+    args = ap.parse_args()
+    ana_setup(ap, args)
+
     return args
 
-def ana_main():
-    args = ana_parse_args()
+def ana_run(args):
+    """プラグインを実行し、args.db を解析結果で更新する。
+
+    キャッシュが有効で、同じ入力に対する解析結果があればそれを使う。
+    """
+    cache_key = None
+    if args.cache_dir and not args.no_cache:
+        plugins = [(identifier, plg_args, Plugin.source_path(identifier))
+                   for identifier, plg_args in args.plugins]
+        cache_key = _anacache.key(args.db, args.bank, plugins, args.irq)
+        db = _anacache.load(args.cache_dir, cache_key)
+        if db is not None:
+            args.db = db
+            return
+
+    ana_run_nocache(args)
 
+    if cache_key is not None:
+        _anacache.store(args.cache_dir, cache_key, args.db)
+
+def ana_run_nocache(args, analyzer=None):
     ops_valid = [Op.get(code).official for code in range(0x100)]
-    perms     = [Permission(True, True, True) for _ in range(0x10000)]
+    perms     = PermissionMap()
 
     for plg_identifier, plg_args in args.plugins:
         plg = Plugin(plg_identifier, plg_args, args.db.org, len(args.bank))
         plg.exec_(args.db, ops_valid, perms)
 
-    analyzer = Analyzer()
+    if analyzer is None: analyzer = Analyzer()
     analyzer.analyze(args.db, args.bank, ops_valid, perms, args.irq)
 
-    args.db.save_script(sys.stdout)
+def ana_save_binary(db, bank, out):
+    """相互参照を(未作成なら)作って、バイナリ形式で保存する。"""
+    MD6502Dis().xrefs(db, bank)
+    db.save_binary(out)
+
+def ana_main():
+    args = ana_parse_args()
+
+    ana_run(args)
+
+    if args.binary:
+        ana_save_binary(args.db, args.bank, sys.stdout.buffer)
+    else:
+        args.db.save_script(sys.stdout)
 
 
 #---------------------------------------------------------------------
@@ -175,35 +379,589 @@ def ana_main():
 FMT_MAP = {
     #"ca65"   : CA65Dis,
     "md6502" : MD6502Dis,
+    "jsonl"  : JsonLinesDis,
 }
 
 def dis_parse_args():
     ap = argparse.ArgumentParser(description="6502 disassembler")
-    ap.add_argument("_buf", type=argparse.FileType("rb"), action=ReadAction, metavar="INFILE")
-    ap.add_argument("--db", type=argparse.FileType("r"), action=DatabaseAction,
-                    help="program database")
-    ap.add_argument("--org", type=addr16,
-                    help="origin address")
+    dis_add_db_arguments(ap)
     ap.add_argument("--fmt", type=str, choices=sorted(FMT_MAP), default="md6502",
                     help="output format")
+    ap.add_argument("--start", type=addr_banked,
+                    help="start address of the range to disassemble (BB:AAAA selects PRG bank BB)")
+    ap.add_argument("--end", type=addr_banked,
+                    help="end address (exclusive) of the range to disassemble")
+    ap.add_argument("--label", metavar="NAME",
+                    help="disassemble from label NAME to the next label")
+    dis_add_xref_argument(ap)
+    dis_add_jobs_argument(ap)
 
     args = ap.parse_args()
+    dis_setup_jobs(ap, args)
+
+    addrs = [a for a in (args.start, args.end) if a is not None]
+    input_select_bank(ap, args, (number for number, _ in addrs))
+    if args.start is not None: args.start = args.start[1]
+    if args.end   is not None: args.end   = args.end[1]
 
-    if args.db is None:
-        if args.org is None: ap.error("origin not specified")
-        args.db = Database(args.org)
+    dis_setup_db(ap, args)
+
+    if args.label is not None:
+        if args.start is not None: ap.error("--label and --start are exclusive")
+        try:
+            label = args.db.get_label(args.label)
+        except KeyError:
+            ap.error("label not found: {}".format(args.label))
+        args.start = label.addr
+        if args.end is None:
+            nexts = [l.addr for l in args.db.labels() if l.addr > label.addr]
+            if nexts: args.end = min(nexts)
+
+    return args
+
+def dis_add_db_arguments(ap, infile=True):
+    if infile:
+        ap.add_argument("_buf", type=argparse.FileType("rb"), action=ReadAction, metavar="INFILE")
+    ap.add_argument("--db",
+                    help="program database (script or binary)")
+    ap.add_argument("--db-mode", choices=DB_MODES, default="auto",
+                    help='how to run a database script ("parse": no Python code, "exec": full Python, "auto": parse if possible)')
+    ap.add_argument("--org", type=addr16,
+                    help="origin address")
+    input_add_arguments(ap)
+
+def dis_setup_db(ap, args):
+    """入力ファイルとデータベースを読み込み、args.bank, args.db を設定する。"""
+    rom = rom_open(ap, args)
+
+    args.db_path = args.db
+    args.db_stat = None
+    if args.db is not None:
+        if args.db != "-":
+            try:
+                args.db_stat = os.stat(args.db)
+            except OSError:
+                pass
+        args.db = db_load(ap, args.db, args.db_mode)
+    else:
+        args.db = Database(default_org(ap, args, rom))
 
     # --db と --org が両方指定された場合、後者を優先(使う場面はあまりないだろうが…)
     if args.org is not None:
         args.db.org = args.org
 
-    if not args._buf: ap.error("input file is empty")
-    args.bank = Bank(args._buf, args.db.org)
+    args.bank = input_bank(ap, args, rom)
 
-    return args
+def dis_add_xref_argument(ap):
+    ap.add_argument("--xref", action="store_true",
+                    help="append cross references to tail comments")
+
+def dis_add_jobs_argument(ap):
+    ap.add_argument("--jobs", type=int, default=1, metavar="N",
+                    help="number of processes for formatting (0: number of CPUs)")
+
+def dis_setup_jobs(ap, args):
+    if args.jobs < 0: ap.error("--jobs must not be negative")
+    if args.jobs == 0: args.jobs = os.cpu_count() or 1
+
+def dis_write(dis, db, bank, start=None, end=None, index=None, jobs=1):
+    """逆アセンブル結果を標準出力に書き出す。
+
+    改行コードの変換が不要なら、テキストレイヤを経由せず直接書き出す。
+    """
+    if os.linesep == "\n" and hasattr(sys.stdout, "buffer"):
+        sys.stdout.flush()
+        dis.dis_binary(db, bank, sys.stdout.buffer, sys.stdout.encoding, sys.stdout.errors,
+                       start, end, index, jobs)
+    else:
+        dis.dis(db, bank, sys.stdout, start, end, index, jobs)
+
+def dis_index(dis, args):
+    """範囲指定の逆アセンブル用に行境界インデックスを用意する。
+
+    データベースファイルごとにキャッシュし、2回目以降はバンク全体を
+    辿らずに済むようにする。
+    """
+    if args.db_stat is not None:
+        data = _indexcache.load(args.db_path, args.db, args.bank)
+        if data is not None:
+            try:
+                index = BoundaryIndex.from_bytes(data)
+                if index.org == args.bank.org and len(index.states) == len(args.bank):
+                    return index
+            except ValueError:
+                pass
+
+    index = BoundaryIndex.build(dis, args.db, args.bank)
+    if args.db_stat is not None:
+        _indexcache.store(args.db_path, args.db, args.bank, index.to_bytes())
+
+    return index
 
 def dis_main():
     args = dis_parse_args()
 
-    dis = FMT_MAP[args.fmt]()
-    dis.dis(args.db, args.bank, sys.stdout)
+    dis = FMT_MAP[args.fmt](xref=args.xref)
+    index = dis_index(dis, args) if args.start is not None or args.jobs > 1 else None
+    dis_write(dis, args.db, args.bank, args.start, args.end, index, args.jobs)
+
+
+#---------------------------------------------------------------------
+# analyzer + disassembler
+#---------------------------------------------------------------------
+
+def run_parse_args():
+    ap = argparse.ArgumentParser(description="td6502 analyzer + disassembler")
+    ana_add_arguments(ap)
+    ap.add_argument("--fmt", type=str, choices=sorted(FMT_MAP), default="md6502",
+                    help="output format")
+    ap.add_argument("--save-db", metavar="FILE",
+                    help="also save the resulting program database")
+    ap.add_argument("--binary", action="store_true",
+                    help="save program database (--save-db) in binary format")
+    dis_add_xref_argument(ap)
+    dis_add_jobs_argument(ap)
+
+    args = ap.parse_args()
+    if args.binary and args.save_db is None:
+        ap.error("--binary requires --save-db")
+    dis_setup_jobs(ap, args)
+    ana_setup(ap, args)
+
+    return args
+
+def run_main():
+    """解析と逆アセンブルを1プロセスで行う。
+
+    td6502-analyze の出力を td6502 に渡すのと同じ結果になるが、データ
+    ベースの書き出し/読み込みを経由しない。
+    """
+    args = run_parse_args()
+
+    ana_run(args)
+
+    if args.save_db is not None:
+        if args.binary:
+            with open(args.save_db, "wb") as out:
+                ana_save_binary(args.db, args.bank, out)
+        else:
+            with open(args.save_db, "w") as out:
+                args.db.save_script(out)
+
+    dis = FMT_MAP[args.fmt](xref=args.xref)
+    dis_write(dis, args.db, args.bank, jobs=args.jobs)
+
+
+#---------------------------------------------------------------------
+# project (multiple banks)
+#---------------------------------------------------------------------
+
+# マニフェストのバンク定義のキー -> td6502-analyze のオプション
+PROJECT_OPTIONS = (
+    ("db",       "--db"),
+    ("db_mode",  "--db-mode"),
+    ("org",      "--org"),
+    ("offset",   "--offset"),
+    ("size",     "--size"),
+    ("prg_bank", "--prg-bank"),
+    ("nmi",      "--nmi"),
+    ("reset",    "--reset"),
+    ("irq",      "--irq"),
+)
+
+class ProjectError(Exception): pass
+
+class _ProjectArgumentParser(argparse.ArgumentParser):
+    """エラー時に終了せず ProjectError を送出する ArgumentParser。"""
+
+    def error(self, message):
+        raise ProjectError(message)
+
+def project_load(path):
+    """マニフェスト (JSON) を読み込む。
+
+    形式:
+
+      {
+        "labels": [ "common.py", ... ],   # 全バンク共通のラベル(省略可)
+        "banks": [
+          {
+            "name":    "prg0",            # 出力ファイル名に使う(パス区切り, ".." は不可)
+            "file":    "foo.nes",
+            "prg_bank": 0,                # 以下は td6502-analyze の同名オプション(省略可)
+                                          # prg_bank はバンク間で重複不可
+            "org":     "0x8000",
+            "offset":  0, "size": 16384,
+            "db":      "prg0-init.py",
+            "nmi": "auto", "reset": "auto", "irq": "auto",
+            "plugins": [ "nes", ... ],    # --plugin
+            "cdl":     "foo.cdl"          # --cdl
+          },
+          ...
+        ]
+      }
+
+    相対パスはマニフェストのディレクトリからの相対とする。
+
+    td6502-xref --project はバンクを PRG バンク番号で区別するので、同じ
+    prg_bank を複数のバンクに指定することはできない。
+    """
+    with open(path, "r") as in_:
+        manifest = json.load(in_)
+
+    base = os.path.dirname(os.path.abspath(path))
+    def resolve(p):
+        return os.path.join(base, p)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("banks"), list):
+        raise ProjectError("manifest must have a list of banks")
+
+    labels = [resolve(p) for p in manifest.get("labels", ())]
+
+    banks = []
+    names = set()
+    prg_banks = {} # PRG バンク番号 -> name
+    for entry in manifest["banks"]:
+        if "name" not in entry or "file" not in entry:
+            raise ProjectError("bank must have name and file")
+        name = str(entry["name"])
+        # 出力ファイル名に使うので --out-dir の外を指せないこと
+        if not name or ".." in name or any(sep and sep in name for sep in ("/", os.sep, os.altsep)):
+            raise ProjectError("invalid bank name: {}".format(name))
+        if name in names: raise ProjectError("duplicate bank name: {}".format(name))
+        names.add(name)
+
+        # 数値でなければ、そのバンクの解析時にエラーとなる
+        prg_bank = _project_prg_bank(entry.get("prg_bank"))
+        if prg_bank is not None:
+            if prg_bank in prg_banks:
+                raise ProjectError("duplicate prg_bank {}: {}, {}".format(prg_bank, prg_banks[prg_bank], name))
+            prg_banks[prg_bank] = name
+
+        argv = [resolve(entry["file"])]
+        for key, opt in PROJECT_OPTIONS:
+            if key in entry:
+                value = resolve(entry[key]) if key == "db" else str(entry[key])
+                argv.append("{}={}".format(opt, value))
+        for plugin in entry.get("plugins", ()):
+            argv.append("--plugin={}".format(plugin))
+        if "cdl" in entry:
+            argv.append("--cdl={}".format(resolve(entry["cdl"])))
+
+        banks.append((name, argv))
+
+    return labels, banks
+
+def _project_prg_bank(value):
+    if value is None: return None
+    try:
+        return int(str(value))
+    except ValueError:
+        return None
+
+def project_check_prg_banks(summaries):
+    """prg_bank を省略した(1バンクの) iNES のバンク番号は解析するまでわか
+    らないので、解析後に重複を調べ、重複したものをエラーとする。
+    """
+    prg_banks = {}
+    for s in summaries:
+        if s["status"] != "ok" or s["prg_bank"] is None: continue
+        if s["prg_bank"] in prg_banks:
+            s["status"] = "error"
+            s["error"]  = "duplicate prg_bank {}: {}, {}".format(s["prg_bank"], prg_banks[s["prg_bank"]], s["name"])
+        else:
+            prg_banks[s["prg_bank"]] = s["name"]
+
+def project_labels(ap, paths):
+    """共通ラベルファイルを読み込み、(name, addr, size) のタプルにする。"""
+    labels = []
+    for path in paths:
+        db = db_load(ap, path, "auto")
+        labels.extend((label.name, label.addr, label.size)
+                      for label in sorted(db.labels(), key=lambda label: label.addr))
+    return tuple(labels)
+
+# ワーカープロセスで共有する共通ラベル(読み取り専用)
+_project_labels = ()
+
+def _project_worker_init(labels):
+    global _project_labels
+    _project_labels = labels
+
+def _project_worker(name, argv, out_path, binary):
+    """1バンクを解析し、結果を out_path に保存する。サマリを返す。"""
+    time_start = time.perf_counter()
+    summary = { "name" : name, "db" : out_path }
+    try:
+        ap = _ProjectArgumentParser(prog=name)
+        ana_add_arguments(ap)
+        args = ap.parse_args(argv)
+        ana_setup(ap, args)
+
+        # バンク側のラベルを優先する
+        for label_name, addr, size in _project_labels:
+            try:
+                args.db.get_label(label_name)
+            except KeyError:
+                args.db.add_label(label_name, addr, size)
+
+        ana_run(args)
+
+        if binary:
+            with open(out_path, "wb") as out:
+                ana_save_binary(args.db, args.bank, out)
+        else:
+            with open(out_path, "w") as out:
+                args.db.save_script(out)
+    except Exception as e:
+        summary["status"] = "error"
+        summary["error"]  = str(e) if isinstance(e, ProjectError) else traceback.format_exc()
+    else:
+        lo, hi = args.bank.org, args.bank.addr_max() + 1
+        analysis = args.db.analysis[lo:hi]
+        summary["status"]   = "ok"
+        summary["file"]     = argv[0]
+        summary["prg_bank"] = args.prg_bank
+        summary["offset"]   = args.offset
+        summary["org"]      = lo
+        summary["size"]     = hi - lo
+        summary["code"]     = analysis.count(Analysis.CODE.value)
+        summary["notcode"]  = analysis.count(Analysis.NOTCODE.value)
+        summary["unknown"]  = analysis.count(Analysis.UNKNOWN.value)
+        summary["labels"]   = len(args.db.labels())
+
+    summary["time"] = round(time.perf_counter() - time_start, 3)
+    return summary
+
+def project_parse_args():
+    ap = argparse.ArgumentParser(description="td6502 project analyzer (multiple banks)")
+    ap.add_argument("manifest", metavar="MANIFEST",
+                    help="project manifest (JSON)")
+    ap.add_argument("--out-dir", default=".",
+                    help="output directory for program databases and summary.json")
+    ap.add_argument("--binary", action="store_true",
+                    help="output program databases in binary format")
+    ap.add_argument("--jobs", type=int, default=0, metavar="N",
+                    help="number of processes (0: number of CPUs)")
+
+    args = ap.parse_args()
+    dis_setup_jobs(ap, args)
+
+    try:
+        label_paths, args.banks = project_load(args.manifest)
+    except (OSError, ValueError, ProjectError) as e:
+        ap.error("can't load manifest: {}".format(e))
+    args.labels = project_labels(ap, label_paths)
+
+    return args
+
+def project_main():
+    """マニフェストに記述された複数バンクをプロセスプールで並列に解析する。
+
+    バンクごとに <out-dir>/<name>.py (--binary なら .bin) を書き出し、
+    結果のサマリを <out-dir>/summary.json に書き出す。
+    """
+    args = project_parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    ext = ".bin" if args.binary else ".py"
+
+    tasks = [(name, argv, os.path.join(args.out_dir, name + ext), args.binary)
+             for name, argv in args.banks]
+
+    # 1プロセスならプールを使わずにこのプロセスで順に解析する
+    jobs = min(args.jobs, len(args.banks))
+    if jobs <= 1:
+        _project_worker_init(args.labels)
+        summaries = [_project_worker(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_project_worker_init,
+                                                    initargs=(args.labels,)) as pool:
+            futures = [pool.submit(_project_worker, *task) for task in tasks]
+            summaries = [f.result() for f in futures]
+    project_check_prg_banks(summaries)
+
+    with open(os.path.join(args.out_dir, "summary.json"), "w") as out:
+        json.dump(summaries, out, indent=2)
+        out.write("\n")
+
+    for s in summaries:
+        if s["status"] == "ok":
+            print("{name}: ok (code {code}, notcode {notcode}, unknown {unknown}, labels {labels}, {time}s)".format(**s))
+        else:
+            print("{}: error".format(s["name"]))
+            print(s["error"].rstrip(), file=sys.stderr)
+
+    if any(s["status"] != "ok" for s in summaries):
+        sys.exit(1)
+
+
+#---------------------------------------------------------------------
+# server
+#---------------------------------------------------------------------
+
+def server_parse_args():
+    ap = argparse.ArgumentParser(description="td6502 server (JSON-RPC over Unix domain socket)")
+    ana_add_arguments(ap)
+    ap.add_argument("--socket", required=True, metavar="PATH",
+                    help="Unix domain socket path")
+
+    args = ap.parse_args()
+    ana_setup(ap, args)
+
+    if os.path.exists(args.socket): ap.error("socket already exists: {}".format(args.socket))
+
+    return args
+
+def server_main():
+    """解析済みの状態を保持し、JSON-RPC で変更/逆アセンブルを受け付ける。
+
+    差分解析のため、解析キャッシュは使わない。
+    """
+    # AF_UNIX の無い環境でも他のコマンドが使えるよう、ここで読み込む
+    from .server import Session, Server
+
+    args = server_parse_args()
+
+    analyzer = Analyzer()
+    ana_run_nocache(args, analyzer)
+
+    server = Server(args.socket, Session(args.db, args.bank, analyzer))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+#---------------------------------------------------------------------
+# cross reference
+#---------------------------------------------------------------------
+
+def xref_parse_args():
+    ap = argparse.ArgumentParser(description="td6502 cross reference",
+                                 usage="%(prog)s [options] INFILE [TARGET ...]\n"
+                                       "       %(prog)s --project=DIR [options] [TARGET ...]")
+    ap.add_argument("--project", metavar="DIR",
+                    help="query all iNES banks in the td6502-project output directory DIR (no INFILE)")
+    dis_add_db_arguments(ap, infile=False)
+    ap.add_argument("--access", type=access_parse, metavar="KINDS",
+                    help='show only these access kinds (e.g. "call/jump"; {})'.format(
+                        "/".join(a.name.lower() for a in Access)))
+    ap.add_argument("operands", nargs="*", metavar="ARG",
+                    help="INFILE (without --project), then targets: label name, address or "
+                         "BB:AAAA (address in PRG bank BB) (default: all referenced addresses)")
+
+    args = ap.parse_args()
+
+    # バンク番号, Bank, Database の列
+    if args.project is not None:
+        if args.db is not None or args.org is not None or args.prg_bank is not None or\
+           args.offset or args.size is not None:
+            ap.error("--project can't be used with input/database options")
+        try:
+            space_ = space.BankedSpace.from_project(args.project)
+        except (OSError, ValueError, KeyError, ScriptError) as e:
+            ap.error("can't load project: {}".format(e))
+        args.banks = [(n, space_.bank(n), space_.db(n)) for n in space_.numbers()]
+        args.targets = args.operands
+    else:
+        if not args.operands: ap.error("INFILE is required")
+        path, args.targets = args.operands[0], args.operands[1:]
+        try:
+            args._buf = read_input(argparse.FileType("rb")(path))
+        except argparse.ArgumentTypeError as e:
+            ap.error(str(e))
+
+        numbers = []
+        for target in args.targets:
+            try:
+                numbers.append(space.parse(target)[0])
+            except ValueError:
+                pass # ラベル名
+        input_select_bank(ap, args, numbers)
+        dis_setup_db(ap, args)
+        args.banks = [(args.prg_bank, args.bank, args.db)]
+
+    args.ranges = [xref_target(ap, args.banks, target) for target in args.targets]
+
+    return args
+
+def xref_target(ap, banks, target):
+    """TARGET を (見出し, [(バンク番号, Bank, Database, 先頭アドレス, サイズ), ...]) にする。
+
+    ラベル名なら、そのラベルを持つ各バンクのラベルの範囲。アドレスなら
+    全バンク(バンク番号付きならそのバンクのみ)の1バイト。
+    """
+    ranges = []
+    for number, bank, db in banks:
+        try:
+            label = db.get_label(target)
+        except KeyError:
+            continue
+        ranges.append((number, bank, db, label.addr, label.size))
+    if ranges: return target, ranges
+
+    try:
+        number, addr = space.parse(target)
+    except ValueError:
+        ap.error("invalid target (neither label nor address): {}".format(target))
+    for entry in banks:
+        if number is None or entry[0] == number:
+            ranges.append(entry + (addr, 1))
+    if not ranges: ap.error("bank not found: {}".format(target))
+
+    name = xref_name([entry[2] for entry in ranges], addr)
+    if number is not None: name = "{:02X}:{}".format(number, name)
+    return name, ranges
+
+def xref_name(dbs, addr):
+    """参照先 addr の表示名(dbs のうち最初に見つかったラベル名、配列ラ
+    ベルなら +N 付き)。
+    """
+    for db in dbs:
+        label = db.get_label_by_addr(addr)
+        if label is None: continue
+        if label.addr == addr: return label.name
+        return "{}+{:d}".format(label.name, addr - label.addr)
+    return "${:04X}".format(addr)
+
+def xref_main():
+    """参照先ごとに、参照元の命令と参照種別を出力する。
+
+    --project の場合、参照元はバンク番号付き (BB:AAAA) で出力する。
+    """
+    args = xref_parse_args()
+
+    dis = MD6502Dis()
+
+    if args.ranges:
+        ranges = args.ranges
+    else:
+        targets = set()
+        for _, bank, db in args.banks:
+            targets.update(dis.xrefs(db, bank).targets())
+        dbs = [db for _, _, db in args.banks]
+        ranges = [(xref_name(dbs, addr), [entry + (addr, 1) for entry in args.banks])
+                  for addr in sorted(targets)]
+
+    for name, entries in ranges:
+        lines = []
+        for number, bank, db, addr, size in entries:
+            dec = bank.decode()
+            for target, src, access in dis.xrefs(db, bank).refs_to_range(addr, size):
+                if args.access is not None and not access & args.access: continue
+                op = dec.op(src)
+                mne = dis._mnemonic(db, src, op, dec.operand(src))
+                if args.project is not None:
+                    src_str = space.linear_str(space.linear(number, src))
+                else:
+                    src_str = "{:04X}".format(src)
+                line = "{} : {} ; {}".format(src_str, mne.ljust(20), access_str(access))
+                if target != addr: line += " +{:d}".format(target - addr)
+                lines.append(line)
+        if not lines and not args.targets: continue
+
+        print("{}:".format(name))
+        for line in lines:
+            print(line)
+        print()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""NumPy による Analyzer の pass 1 (命令単位のコード判定) の実装。
+
+NumPy がインストールされていない場合、このモジュールの import は
+ImportError となる(ana.py 側で純 Python 実装にフォールバックする)。
+"""
+
+
+import numpy as np
+
+from . import PermissionMap
+from .op import Op
+from .db import Analysis
+
+
+_UNKNOWN = Analysis.UNKNOWN.value
+_NOTCODE = Analysis.NOTCODE.value
+
+_READABLE   = PermissionMap.READABLE
+_WRITABLE   = PermissionMap.WRITABLE
+_EXECUTABLE = PermissionMap.EXECUTABLE
+
+
+def _op_table(pred):
+    return np.array([bool(pred(Op.get(code))) for code in range(0x100)])
+
+_T_BRK  = _op_table(lambda op: op.mode is Op.Mode.BRK)
+_T_REL  = _op_table(lambda op: op.mode is Op.Mode.REL)
+_T_JMPI = _op_table(lambda op: op.code == 0x6C)
+_T_ZPAB = _op_table(lambda op: op.mode in (Op.Mode.ZP, Op.Mode.AB))
+_T_ZPI  = _op_table(lambda op: op.mode in (Op.Mode.ZPX, Op.Mode.ZPY, Op.Mode.IX))
+_T_ABI  = _op_table(lambda op: op.mode in (Op.Mode.ABX, Op.Mode.ABY))
+_T_IY   = _op_table(lambda op: op.mode is Op.Mode.IY)
+_T_R    = _op_table(lambda op: op.argread)
+_T_W    = _op_table(lambda op: op.argwrite)
+_T_X    = _op_table(lambda op: op.argexec)
+
+# インデックス付きアドレッシングで実行パーミッションを要する命令はない
+# ものとして実装している(あれば純 Python 実装を使う)
+SUPPORTED = not np.any((_T_ZPI | _T_ABI) & _T_X)
+
+
+def _window_counts(legal, addrs):
+    """addrs の各要素から 0x100 バイト(wrap around)の範囲内で legal な
+    アドレスの数を返す。
+    """
+    sums = np.concatenate(([0], np.cumsum(legal, dtype=np.int64)))
+    end  = addrs + 0x100
+    wrap = end > 0x10000
+    return np.where(wrap,
+                    (sums[0x10000] - sums[addrs]) + sums[np.where(wrap, end - 0x10000, 0)],
+                    sums[np.minimum(end, 0x10000)] - sums[addrs])
+
+def analyze_single(db, dec, ops_valid, perms, irq):
+    """Analyzer._analyze_single() と同じ判定をバンク全体に対して一括で行う。
+
+    純 Python 実装はアドレス昇順に判定を行い、判定結果は以降の判定(
+    実行先が NOTCODE かどうか)に影響する。ここでは実行先に依存しない
+    判定を一括で行った後、実行先がバンク内の手前のアドレスであるもの
+    のみをアドレス昇順に判定することで同じ結果を得る。
+    """
+    org = dec.org
+    n   = len(dec.opcodes)
+    addrs = np.arange(org, org + n, dtype=np.int64)
+
+    an_all     = np.frombuffer(bytes(db.analysis), dtype=np.uint8)
+    notcode_all = an_all == _NOTCODE
+    an      = an_all[org:org+n]
+    unknown = an == _UNKNOWN
+
+    codes   = np.frombuffer(dec.opcodes, dtype=np.uint8)
+    valid   = np.array([bool(v) for v in ops_valid])[codes]
+    trunc   = np.frombuffer(bytes(dec.truncated), dtype=np.uint8).astype(bool)
+    operand = np.array(dec.operands, dtype=np.int64)
+    operand = np.where(operand < 0, 0, operand)
+
+    flags = np.frombuffer(bytes(perms.flags), dtype=np.uint8)
+    rd = (flags & _READABLE)   != 0
+    wr = (flags & _WRITABLE)   != 0
+    ex = (flags & _EXECUTABLE) != 0
+
+    argr = _T_R[codes]
+    argw = _T_W[codes]
+    argx = _T_X[codes]
+
+    illegal = np.zeros(n, dtype=bool)
+    target  = np.full(n, -1, dtype=np.int64) # 実行先(NOTCODE 判定に使う)
+
+    # BRK
+    if irq is not None:
+        m = _T_BRK[codes]
+        illegal |= m & (not ex[irq] or not rd[irq])
+        target[m] = irq
+
+    # 分岐命令
+    m = _T_REL[codes]
+    lo = operand & 0xFF
+    rel = (addrs + 2 + np.where(lo < 0x80, lo, lo - 0x100)) & 0xFFFF
+    illegal |= m & (~ex[rel] | ~rd[rel])
+    target = np.where(m, rel, target)
+
+    # JMP ind
+    m = _T_JMPI[codes]
+    hi = (operand & 0xFF00) | ((operand + 1) & 0xFF)
+    illegal |= m & (~rd[operand] | ~rd[hi])
+
+    # zp, abs
+    m = _T_ZPAB[codes] & ~_T_JMPI[codes]
+    illegal |= m & ((argr & ~rd[operand]) | (argw & ~wr[operand]) | (argx & ~ex[operand]))
+    target = np.where(m & argx, operand, target)
+
+    # zpx, zpy, ix, abx, aby
+    m_zpi = _T_ZPI[codes]
+    m_abi = _T_ABI[codes]
+    masks = np.where(argr, _READABLE, 0) | np.where(argw, _WRITABLE, 0)
+    for mask in np.unique(masks[m_zpi | m_abi]):
+        legal = (flags & mask) == mask
+        m = masks == mask
+        illegal |= m & m_zpi & (_window_counts(legal, np.zeros(1, dtype=np.int64))[0] == 0)
+        illegal |= m & m_abi & (_window_counts(legal, operand) == 0)
+
+    # iy
+    m = _T_IY[codes]
+    hi = (operand + 1) & 0xFF
+    illegal |= m & (~rd[operand] | ~rd[hi])
+
+    cand = unknown & valid & ~trunc
+    new_notcode = unknown & ~valid
+    new_notcode |= cand & illegal
+
+    # 実行先が NOTCODE かどうかの判定。実行先がバンク内の手前のアドレス
+    # の場合、その判定結果に依存するので後回しにする
+    has_target = cand & ~illegal & (target >= 0)
+    target_ok  = np.where(has_target, target, 0)
+    deferred   = has_target & (target_ok >= org) & (target_ok < addrs)
+    new_notcode |= has_target & ~deferred & notcode_all[target_ok]
+
+    notcode = bytearray((an == _NOTCODE) | new_notcode)
+    for i in np.flatnonzero(deferred).tolist():
+        if notcode[int(target[i]) - org]:
+            notcode[i] = 1
+            new_notcode[i] = True
+
+    result = np.where(new_notcode, _NOTCODE, an).astype(np.uint8)
+    db.analysis[org:org+n] = result.tobytes()
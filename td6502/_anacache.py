@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""解析結果のキャッシュ。
+
+解析の入力(バンクの内容、解析前のデータベース、プラグインとその引数・
+ソース、IRQ アドレス、td6502 自身のバージョンとソース)のハッシュをキー
+とし、解析後のデータベースをバイナリ形式で保存する。
+
+キャッシュディレクトリの合計サイズが上限を超えた場合、最も長く使われ
+ていないものから削除する(使用時にエントリの mtime を更新している)。
+
+キャッシュの読み書きに失敗してもエラーにはしない。
+"""
+
+
+import os
+import os.path
+import io
+import glob
+import hashlib
+
+from . import __version__
+from .db import Database
+
+
+MAX_BYTES = 256 * 1024 * 1024
+
+_SUFFIX = ".tddb"
+
+_source_digest = None
+
+
+def key(db, bank, plugins, irq):
+    """解析の入力からキャッシュのキー(16進文字列)を作る。
+
+    db は割り込みベクタの登録などを済ませた解析直前のもの。plugins は
+    (識別子, 引数リスト, ソースファイルのパス) の列。引数のうち既存
+    ファイルを指すもの (CDL ファイルなど) はその内容もキーに含める。
+    """
+    h = hashlib.sha256()
+
+    def feed(tag, data):
+        if isinstance(data, str): data = data.encode("utf-8")
+        h.update(tag + len(data).to_bytes(8, "little") + data)
+
+    feed(b"ver", __version__)
+    feed(b"src", _td6502_digest())
+    feed(b"org", str(bank.org))
+    feed(b"bnk", bank.view())
+    feed(b"irq", repr(irq))
+
+    buf = io.BytesIO()
+    db.save_binary(buf)
+    feed(b"db", buf.getvalue())
+
+    for identifier, args, source in plugins:
+        feed(b"plg", identifier)
+        feed(b"psrc", _file_bytes(source) if source else b"")
+        for arg in args:
+            feed(b"arg", arg)
+            if os.path.isfile(arg):
+                feed(b"afile", _file_bytes(arg))
+
+    return h.hexdigest()
+
+def load(dir_, key_):
+    """キャッシュにあれば解析後の Database を返す。なければ None。"""
+    entry = _entry_path(dir_, key_)
+    try:
+        db = Database.load_binary(entry)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+    return db
+
+def store(dir_, key_, db):
+    entry = _entry_path(dir_, key_)
+    tmp   = "{}.{}.tmp".format(entry, os.getpid())
+    try:
+        os.makedirs(dir_, exist_ok=True)
+        with open(tmp, "wb") as out:
+            db.save_binary(out)
+        os.replace(tmp, entry)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+
+    _evict(dir_)
+
+def _entry_path(dir_, key_):
+    return os.path.join(dir_, key_ + _SUFFIX)
+
+def _evict(dir_):
+    try:
+        entries = [e for e in os.scandir(dir_) if e.name.endswith(_SUFFIX)]
+        stats   = { e.path : e.stat() for e in entries }
+        total   = sum(st.st_size for st in stats.values())
+        if total <= MAX_BYTES: return
+
+        for path in sorted(stats, key=lambda p: stats[p].st_mtime_ns):
+            os.remove(path)
+            total -= stats[path].st_size
+            if total <= MAX_BYTES: break
+    except OSError:
+        pass
+
+def _td6502_digest():
+    """td6502 パッケージのソースのハッシュ(開発中はバージョンが変わらないため)。"""
+    global _source_digest
+    if _source_digest is None:
+        h = hashlib.sha256()
+        pkg = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(pkg, "*.py"))):
+            h.update(os.path.basename(path).encode("utf-8") + b"\0" + _file_bytes(path))
+        _source_digest = h.digest()
+    return _source_digest
+
+def _file_bytes(path):
+    with open(path, "rb") as in_:
+        return in_.read()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""逆アセンブル用の行境界インデックス (dis.BoundaryIndex) のキャッシュ。
+
+データベースファイルと同じディレクトリの __td6502cache__/ に保存する
+(_scriptcache と共用)。読み込んだデータベースの解析結果とデータ型、
+およびバンクの内容と origin が記録と一致する場合のみキャッシュを使う
+(行境界はこれらのみで決まる)。データベースファイル自体の mtime など
+は見ないので、include() したファイルの変更も反映される。
+
+キャッシュの読み書きに失敗してもエラーにはしない。
+"""
+
+
+import os
+import os.path
+import struct
+import hashlib
+
+from . import _scriptcache
+from . import util
+
+
+_MAGIC = b"TDIX"
+
+# マジック, データベースとバンクのダイジェスト
+_HEADER = struct.Struct("<4s20s")
+
+
+def load(db_path, db, bank):
+    """キャッシュが有効ならインデックスのバイト列を返す。なければ None。"""
+    entry = _entry_path(db_path)
+    try:
+        with open(entry, "rb") as in_:
+            data = in_.read()
+    except OSError:
+        return None
+
+    if len(data) < _HEADER.size: return None
+    if _HEADER.unpack_from(data) != _header(db, bank): return None
+
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+    return data[_HEADER.size:]
+
+def store(db_path, db, bank, data):
+    """インデックスのバイト列を保存する。"""
+    entry = _entry_path(db_path)
+    tmp   = "{}.{}.tmp".format(entry, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with open(tmp, "wb") as out:
+            out.write(_HEADER.pack(*_header(db, bank)))
+            out.write(data)
+        os.replace(tmp, entry)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+
+    _scriptcache._evict(os.path.dirname(entry))
+
+def _header(db, bank):
+    h = hashlib.sha1(util.pack_u(bank.org, 2))
+    h.update(util.pack_u(len(bank), 4))
+    h.update(bank.view())
+    h.update(db.analysis)
+    h.update(db.data_types)
+    return (_MAGIC, h.digest())
+
+def _entry_path(db_path):
+    dir_, name = os.path.split(os.path.abspath(db_path))
+    return os.path.join(dir_, _scriptcache.CACHE_DIR, "{}.idx.bin".format(name))
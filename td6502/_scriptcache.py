@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""データベーススクリプトのコンパイル結果のキャッシュ。
+
+スクリプトと同じディレクトリの __td6502cache__/ にコードオブジェクト
+を marshal して保存する(__pycache__ と同様)。スクリプトの mtime と
+サイズが記録と一致する場合のみキャッシュを使う。
+
+エントリ数が上限を超えた場合、最も長く使われていないものから削除す
+る(使用時にエントリの mtime を更新している)。
+
+キャッシュの読み書きに失敗しても(読み取り専用ディレクトリなど)エラー
+にはせず、単にキャッシュなしとして扱う。
+"""
+
+
+import sys
+import os
+import os.path
+import struct
+import marshal
+import importlib.util
+
+
+CACHE_DIR   = "__td6502cache__"
+MAX_ENTRIES = 256
+
+# Python の magic number, スクリプトの mtime (ns), スクリプトのサイズ
+_HEADER = struct.Struct("<4sQQ")
+
+
+def load(path):
+    """path のキャッシュが有効ならコードオブジェクトを返す。なければ None。"""
+    entry = _entry_path(path)
+    try:
+        st = os.stat(path)
+        with open(entry, "rb") as in_:
+            data = in_.read()
+    except OSError:
+        return None
+
+    if len(data) < _HEADER.size: return None
+    magic, mtime_ns, size = _HEADER.unpack_from(data)
+    if (magic, mtime_ns, size) != (importlib.util.MAGIC_NUMBER, st.st_mtime_ns, st.st_size):
+        return None
+
+    try:
+        code = marshal.loads(data[_HEADER.size:])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+    # LRU 用に使用時刻を更新
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+    return code
+
+def compile_file(path):
+    """path のスクリプトをコンパイルしたコードオブジェクトを返す。
+
+    キャッシュが有効ならそれを使い、そうでなければコンパイルしてキャッ
+    シュに保存する。
+    """
+    code = load(path)
+    if code is not None: return code
+
+    # 読み込み中にファイルが変更された場合に備え、stat を先に取る
+    # (変更されていれば次回 mtime が一致せず再コンパイルされる)
+    st = os.stat(path)
+    with open(path, "r") as in_:
+        source = in_.read()
+    code = compile(source, path, "exec")
+
+    _store(path, st, code)
+    return code
+
+def _entry_path(path):
+    dir_, name = os.path.split(os.path.abspath(path))
+    return os.path.join(dir_, CACHE_DIR, "{}.{}.bin".format(name, sys.implementation.cache_tag))
+
+def _store(path, st, code):
+    entry = _entry_path(path)
+    tmp   = "{}.{}.tmp".format(entry, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with open(tmp, "wb") as out:
+            out.write(_HEADER.pack(importlib.util.MAGIC_NUMBER, st.st_mtime_ns, st.st_size))
+            out.write(marshal.dumps(code))
+        os.replace(tmp, entry)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+
+    _evict(os.path.dirname(entry))
+
+def _evict(dir_):
+    try:
+        entries = [e for e in os.scandir(dir_) if e.name.endswith(".bin")]
+        if len(entries) <= MAX_ENTRIES: return
+
+        entries.sort(key=lambda e: e.stat().st_mtime_ns)
+        for e in entries[:len(entries)-MAX_ENTRIES]:
+            os.remove(e.path)
+    except OSError:
+        pass
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
 
+import array
+import heapq
+import itertools
+
+from . import PermissionMap
 from .op import Op
 from .db import Analysis
 from . import util
 
+try:
+    from . import _ana_numpy
+except ImportError:
+    _ana_numpy = None
+
 
 _UNKNOWN = Analysis.UNKNOWN
 _CODE    = Analysis.CODE
@@ -12,11 +22,11 @@ _NOTCODE = Analysis.NOTCODE
 
 
 def _not_executable(db, perms, addr):
-    return db.is_notcode(addr) or not perms[addr].executable
+    return db.is_notcode(addr) or not perms.executable(addr)
 
 def _access_illegal(db, perms, addr, op):
-    if op.argread  and not perms[addr].readable:         return True
-    if op.argwrite and not perms[addr].writable:         return True
+    if op.argread  and not perms.readable(addr):         return True
+    if op.argwrite and not perms.writable(addr):         return True
     if op.argexec  and _not_executable(db, perms, addr): return True
     return False
 
@@ -27,50 +37,150 @@ def _abi_addrs(addr):
         yield addr
         addr = util.addr_add(addr, 1)
 
-def _op_nexts(addr, op, operand, irq):
-    """命令 op 実行後の飛び先の候補を全て返す。候補数は 0,1,2 のいずれか。
+def _window_illegal(db, perms, summary, addr, op):
+    """addr から 0x100 バイト(16bit アドレス空間で wrap around)の全ア
+    ドレスについて、op によるアクセスが不正かどうかを返す。
+    """
+    # 実行パーミッションは解析中に変化する db に依存するので愚直に調べる
+    if op.argexec:
+        return all(_access_illegal(db, perms, i, op) for i in _abi_addrs(addr))
+
+    mask = (PermissionMap.READABLE if op.argread  else 0) |\
+           (PermissionMap.WRITABLE if op.argwrite else 0)
+    return summary.count_window(addr, mask) == 0
+
 
-    候補数1の場合のみ飛び先が特定できないことがある。その場合飛び先を
-    None で表す。
+class _PermSummary:
+    """パーミッションの累積和。
+
+    「あるアドレス範囲内に、指定したフラグを全て持つアドレスがいくつ
+    あるか」を O(1) で求めるためのもの。フラグの組み合わせごとに初回
+    問い合わせ時に構築する。構築後に perms を変更してはならない。
     """
-    # KIL
-    if op.code in (0x02, 0x12, 0x22, 0x32, 0x42, 0x52, 0x62, 0x72, 0x92, 0xB2, 0xD2, 0xF2):
-        return ()
-    # BRK
-    elif op.code == 0x00:
-        return (irq,)
-    # JSR, JMP abs
-    elif op.code in (0x20, 0x4C):
-        return (operand,)
-    # JMP ind, RTS, RTI
-    elif op.code in (0x6C, 0x60, 0x40):
-        return (None,)
-    # 分岐命令
-    elif op.mode is Op.Mode.REL:
-        after  = addr + 2
-        target = addr + 2 + util.u8_to_s8(operand)
-
-        # アドレス空間内で wrap around するケースはどう扱うべきか判然
-        # としないので、とりあえず飛び先なしとして判定を打ち切る
-        if after > 0xFFFF or target < 0 or target > 0xFFFF:
-            return ()
-
-        return tuple({ after, target }) # 一致するケースがありうるので
-    # その他
-    else:
-        after = addr + op.size
-
-        # アドレス空間内で wrap around するケースはどう扱うべきか判然
-        # としないので、とりあえず飛び先なしとして判定を打ち切る
-        if after > 0xFFFF:
-            return ()
-
-        return (after,)
+
+    def __init__(self, perms):
+        self._perms = perms
+        self._sums  = {}
+
+    def count_window(self, addr, mask):
+        """addr から 0x100 バイト(wrap around)の範囲で、mask のフラグを
+        全て持つアドレスの数を返す。
+        """
+        sums = self._sums.get(mask)
+        if sums is None:
+            sums = self._sums[mask] = self._build(mask)
+
+        end = addr + 0x100
+        if end <= 0x10000:
+            return sums[end] - sums[addr]
+        else:
+            return (sums[0x10000] - sums[addr]) + sums[end - 0x10000]
+
+    def _build(self, mask):
+        table = bytes(int(b & mask == mask) for b in range(0x100))
+        legal = self._perms.flags.translate(table)
+        return array.array("l", itertools.accumulate(legal, initial=0))
+
+
+# インデックス付きアドレッシングで実行パーミッションを要する命令があるか
+# (あれば pass 1 の判定がウィンドウ内の全アドレスに依存するので、差分
+# 解析はできない)
+_EXEC_WINDOW = any(Op.get(code).argexec and
+                   Op.get(code).mode in (Op.Mode.ZPX, Op.Mode.ZPY, Op.Mode.IX, Op.Mode.ABX, Op.Mode.ABY)
+                   for code in range(0x100))
+
+
+class _SingleView:
+    """差分解析の pass 1 で、1アドレスの判定時点の解析結果を見せるもの。
+
+    _analyze_single_perm() に db の代わりに渡す。バンク内で判定対象よ
+    り手前のアドレスは pass 1 の結果を、それ以外は解析前の値を返す。
+    """
+
+    def __init__(self, seed, single, org):
+        self.seed   = seed
+        self.single = single
+        self.org    = org
+        self.addr   = None
+        self.result = _UNKNOWN
+
+    def is_notcode(self, addr):
+        an = self.single if self.org <= addr < self.addr else self.seed
+        return an[addr] == _NOTCODE.value
+
+    def change_analysis(self, addr, from_, to):
+        self.result = to
+
+class _AnalysisState:
+    """直前の解析の入力と各 pass 後の解析結果(差分解析用)。"""
+
+    def __init__(self, db, bank, ops_valid, perms, irq):
+        self.db        = db
+        self.bank      = bank
+        self.ops_valid = tuple(bool(v) for v in ops_valid)
+        self.perms     = PermissionMap()
+        self.perms.flags[:] = perms.flags
+        self.irq       = irq
+
+        self.seed   = None # 解析前
+        self.single = None # pass 1 後
+        self.flow   = None # pass 2 (UNKNOWN -> NOTCODE) 後
+        self.final  = None # 解析後
+
+        self.autolabels = {} # pass 3 で振ったラベル (アドレス -> 名前)
+
+        self._preds      = None
+        self._preds_exec = None
+        self._preds_call = None
+
+    def indexes(self):
+        """飛び先→飛び元のインデックスを返す(初回のみ構築)。
+
+        preds:      nexts() の飛び先 -> 飛び元
+        preds_exec: pass 1 で実行可否を見る飛び先 -> 飛び元
+        preds_call: JSR / JMP abs の飛び先 -> 飛び元 (pass 3 の対象範囲のみ)
+        """
+        if self._preds is None:
+            bank = self.bank
+            dec  = bank.decode()
+            preds      = {}
+            preds_exec = {}
+            preds_call = {}
+            for addr in range(bank.org, bank.addr_max()+1):
+                if dec.is_truncated(addr): continue
+
+                for next_ in dec.nexts(addr, self.irq):
+                    if next_ is not None:
+                        preds.setdefault(next_, []).append(addr)
+
+                op = dec.op(addr)
+                operand = dec.operand(addr)
+                if op.mode is Op.Mode.BRK:
+                    target = self.irq
+                elif op.mode is Op.Mode.REL:
+                    target = util.rel_target(addr, operand)
+                elif op.code != 0x6C and op.mode in (Op.Mode.ZP, Op.Mode.AB) and op.argexec:
+                    target = operand
+                else:
+                    target = None
+                if target is not None:
+                    preds_exec.setdefault(target, []).append(addr)
+
+                if op.code in (0x20, 0x4C) and addr <= bank.addr_max()-2:
+                    preds_call.setdefault(operand, []).append(addr)
+
+            self._preds, self._preds_exec, self._preds_call = preds, preds_exec, preds_call
+
+        return self._preds, self._preds_exec, self._preds_call
 
 
 class Analyzer:
-    def __init__(self):
-        pass
+    def __init__(self, vectorize=True):
+        """vectorize: NumPy が使える場合、pass 1 を NumPy で一括処理する"""
+        self.vectorize = vectorize and _ana_numpy is not None and _ana_numpy.SUPPORTED
+
+        self._state      = None
+        self._autolabels = None # pass 3 で振ったラベルの記録先
 
     def analyze(self, db, bank, ops_valid, perms, irq):
         """コードを解析し、プログラムデータベースを更新する。
@@ -78,17 +188,211 @@ class Analyzer:
         db: プログラムデータベース
         bank: バンク
         ops_valid: オペコードの有効/無効 (0x100 要素の bool 配列)
-        perms: アドレスごとのパーミッション (0x10000 要素の Permission 配列)
+        perms: アドレスごとのパーミッション (PermissionMap)
         irq: IRQ 割り込みアドレス (None: 指定なし)
+
+        各 pass の結果は reanalyze() のために保持しておく。
         """
+        journal, db.journal = db.journal, None
+        db.xrefs = None # db.analysis を直接書き換える箇所もあるので
+
+        state = _AnalysisState(db, bank, ops_valid, perms, irq)
+        state.seed = bytes(db.analysis)
+
         # pass 1: 命令単位のコード判定
         self._analyze_single(db, bank, ops_valid, perms, irq)
+        state.single = bytes(db.analysis)
 
         # pass 2: 制御フローを考慮したコード判定
-        self._analyze_flow(db, bank, irq)
+        self._analyze_flow_unknown(db, bank, irq)
+        state.flow = bytes(db.analysis)
+        self._analyze_flow_code(db, bank, irq)
+        state.final = bytes(db.analysis)
 
         # pass 3: ラベル振り
+        self._autolabels = state.autolabels
         self._analyze_label(db, bank)
+        self._autolabels = None
+
+        self._state = state
+        db.journal = journal
+
+    def reanalyze(self, db, bank, changes):
+        """直前の analyze() (または reanalyze()) 以降の変更を反映する。
+
+        changes は Journal (Database.take_journal() の結果)。changes.analysis
+        のアドレスについては現在の db の値を解析前の値とみなし、その上で
+        解析をやり直したのと同じ結果にする。ただし実際に再計算するのは
+        変更の影響が及びうる範囲のみ。
+
+        結果が変化しうるアドレス(解析結果またはラベル)の集合を返す。
+        """
+        state = self._state
+        if state is None or state.db is not db or state.bank is not bank:
+            raise ValueError("reanalyze() requires a previous analysis of the same db and bank")
+
+        journal, db.journal = db.journal, None
+        db.xrefs = None # db.analysis を直接書き換える箇所もあるので
+
+        seed = bytearray(state.seed)
+        for addr in changes.analysis:
+            seed[addr] = db.analysis[addr]
+
+        if _EXEC_WINDOW:
+            affected = self._reanalyze_full(db, bank, state, seed)
+        else:
+            affected = self._reanalyze_diff(db, bank, state, seed, changes)
+
+        db.journal = journal
+        return affected
+
+    def _reanalyze_full(self, db, bank, state, seed):
+        final = state.final
+        for addr, name in state.autolabels.items():
+            self._remove_autolabel(db, addr, name)
+        db.analysis[:] = seed
+
+        self.analyze(db, bank, state.ops_valid, state.perms, state.irq)
+
+        affected = set(i for i in range(0x10000) if final[i] != db.analysis[i])
+        affected.update(state.autolabels)
+        affected.update(self._state.autolabels)
+        return affected
+
+    def _reanalyze_diff(self, db, bank, state, seed, changes):
+        dec = bank.decode()
+        preds, preds_exec, preds_call = state.indexes()
+
+        def neighbors(addr):
+            if dec.contains(addr) and not dec.is_truncated(addr):
+                for next_ in dec.nexts(addr, state.irq):
+                    if next_ is not None: yield next_
+            yield from preds.get(addr, ())
+
+        def component(starts, member):
+            """starts から member を満たすアドレスのみをたどって到達できる範囲。"""
+            result = set(a for a in starts if member(a))
+            stack  = list(result)
+            while stack:
+                for other in neighbors(stack.pop()):
+                    if other not in result and member(other):
+                        result.add(other)
+                        stack.append(other)
+            return result
+
+        def around(addrs, member):
+            starts = set()
+            for addr in addrs:
+                starts.add(addr)
+                starts.update(neighbors(addr))
+            return component(starts, member)
+
+        # pass 1: 変更箇所と、その実行可否を見ているアドレスを再判定する。
+        # 判定は手前のアドレスの結果に依存するのでアドレス昇順に行う
+        single  = bytearray(state.single)
+        changed = set()
+        for addr in changes.analysis:
+            if not dec.contains(addr):
+                single[addr] = seed[addr]
+            if single[addr] != state.single[addr]:
+                changed.add(addr)
+
+        view    = _SingleView(seed, single, bank.org)
+        summary = _PermSummary(state.perms)
+        heap = [a for a in set(changes.analysis) | set(a for c in changes.analysis for a in preds_exec.get(c, ()))
+                if dec.contains(a)]
+        heapq.heapify(heap)
+        queued = set(heap)
+        while heap:
+            addr = heapq.heappop(heap)
+            value = self._single_one(view, dec, state, summary, seed, addr)
+            if value != single[addr]:
+                single[addr] = value
+                for pred in preds_exec.get(addr, ()):
+                    if pred > addr and pred not in queued:
+                        queued.add(pred)
+                        heapq.heappush(heap, pred)
+            if single[addr] != state.single[addr]:
+                changed.add(addr)
+            else:
+                changed.discard(addr)
+
+        # pass 2 (UNKNOWN -> NOTCODE): 探索は UNKNOWN のアドレスのみをた
+        # どるので、変化箇所の周辺の UNKNOWN の連結成分のみやり直す
+        unknown = _UNKNOWN.value
+        region  = around(changed, lambda a: single[a] == unknown)
+
+        flow = bytearray(state.flow)
+        for addr in changed: flow[addr] = single[addr]
+        for addr in region:  flow[addr] = unknown
+        db.analysis[:] = flow
+
+        done = bytearray(0x10000)
+        for addr in sorted(region):
+            if not dec.contains(addr): continue
+            if not db.is_unknown(addr): continue
+            if done[addr]: continue
+            self._analyze_flow_unknown_one(db, dec, state.irq, addr, done)
+
+        flow = bytes(db.analysis)
+        changed = set(a for a in changed | region if flow[a] != state.flow[a])
+
+        # pass 2 (UNKNOWN -> CODE): 同様に CODE / UNKNOWN の連結成分のみ
+        notcode = _NOTCODE.value
+        region  = around(changed, lambda a: flow[a] != notcode)
+
+        final = bytearray(state.final)
+        for addr in changed: final[addr] = flow[addr]
+        for addr in region:  final[addr] = flow[addr]
+        db.analysis[:] = final
+
+        done = bytearray(0x10000)
+        for addr in sorted(region):
+            if not dec.contains(addr): continue
+            if not db.is_code(addr): continue
+            if done[addr]: continue
+            self._analyze_flow_code_one(db, dec, state.irq, addr, done)
+
+        final = bytes(db.analysis)
+        changed = set(a for a in changed | region if final[a] != state.final[a])
+
+        # pass 3: 判定が変わりうる飛び先のみやり直す
+        dsts = set(changed) | set(changes.labels)
+        for addr in changed:
+            if bank.org <= addr <= bank.addr_max()-2 and dec.opcode(addr) in (0x20, 0x4C):
+                dsts.add(dec.operand(addr))
+        dsts.add(bank.org)
+
+        autolabels = dict(state.autolabels)
+        self._autolabels = autolabels
+        for dst in sorted(dsts):
+            name = autolabels.pop(dst, None)
+            if name is not None:
+                self._remove_autolabel(db, dst, name)
+
+            if dst == bank.org and bank.org <= bank.addr_max()-2 and db.is_code(dst):
+                self._autolabel(db, dst)
+            elif not db.is_notcode(dst) and\
+                 any(not db.is_notcode(src) for src in preds_call.get(dst, ())):
+                self._autolabel(db, dst)
+        self._autolabels = None
+
+        state.seed, state.single, state.flow, state.final = bytes(seed), bytes(single), flow, final
+        state.autolabels = autolabels
+
+        return changed | dsts
+
+    def _single_one(self, view, dec, state, summary, seed, addr):
+        """差分解析用に、1アドレスについて pass 1 の判定を行う。"""
+        if seed[addr] != _UNKNOWN.value: return seed[addr]
+        if not state.ops_valid[dec.opcode(addr)]: return _NOTCODE.value
+        if dec.is_truncated(addr): return _UNKNOWN.value
+
+        view.addr   = addr
+        view.result = _UNKNOWN
+        self._analyze_single_perm(view, addr, dec.op(addr), dec.operand(addr),
+                                  state.perms, summary, state.irq)
+        return view.result.value
 
     def _analyze_single(self, db, bank, ops_valid, perms, irq):
         """命令単位のコード判定(制御フローを考慮しない)。
@@ -101,44 +405,49 @@ class Analyzer:
         バンク内のオペコード/オペランドのフェッチ、およびオペコードの
         実行は暗黙的に許可されているとみなす。
         """
+        if self.vectorize:
+            _ana_numpy.analyze_single(db, bank.decode(), ops_valid, perms, irq)
+        else:
+            self._analyze_single_py(db, bank, ops_valid, perms, irq)
+
+    def _analyze_single_py(self, db, bank, ops_valid, perms, irq):
+        dec     = bank.decode()
+        summary = _PermSummary(perms)
         for addr in range(bank.org, bank.addr_max()+1):
             if not db.is_unknown(addr): continue
 
-            op = Op.get(bank[addr])
-
             # 無効オペコードは即 NOTCODE
-            if not ops_valid[op.code]:
+            if not ops_valid[dec.opcode(addr)]:
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
                 continue
 
             # 有効オペコードの場合、まず尻切れになってたら放置
-            if not bank.addr_contains(addr + op.size - 1):
+            if dec.is_truncated(addr):
                 continue
 
             # 尻切れでない有効オペコードはオペランドを見て判定
-            operand = util.unpack_u(bank[addr+1:addr+1+op.argsize]) if op.argsize else None
-            self._analyze_single_perm(db, addr, op, operand, perms, irq)
+            self._analyze_single_perm(db, addr, dec.op(addr), dec.operand(addr), perms, summary, irq)
 
-    def _analyze_single_perm(self, db, addr, op, operand, perms, irq):
+    def _analyze_single_perm(self, db, addr, op, operand, perms, summary, irq):
         """アドレスごとのパーミッションに基づくコード判定。
 
         _analyze_single() の下請け。
         """
         # BRK
         if op.mode is Op.Mode.BRK and irq is not None:
-            if _not_executable(db, perms, irq) or not perms[irq].readable:
+            if _not_executable(db, perms, irq) or not perms.readable(irq):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
         # 分岐命令
         elif op.mode is Op.Mode.REL:
             target = util.rel_target(addr, operand)
-            if _not_executable(db, perms, target) or not perms[target].readable:
+            if _not_executable(db, perms, target) or not perms.readable(target):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
         # JMP ind
         # ページまたぎ時は wrap around することに注意
         # http://www.6502.org/tutorials/6502opcodes.html#JMP
         elif op.code == 0x6C:
             hi = (operand & 0xFF00) | ((operand+1) & 0xFF)
-            if not perms[operand].readable or not perms[hi].readable:
+            if not perms.readable(operand) or not perms.readable(hi):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
         # zp, abs
         elif op.mode in (Op.Mode.ZP, Op.Mode.AB):
@@ -149,21 +458,21 @@ class Analyzer:
         # (zpx, zpy, ix はページまたぎ時に wrap around する)
         # http://wiki.nesdev.com/w/index.php/CPU_addressing_modes
         elif op.mode in (Op.Mode.ZPX, Op.Mode.ZPY, Op.Mode.IX):
-            if all(_access_illegal(db, perms, i, op) for i in range(0xFF+1)):
+            if _window_illegal(db, perms, summary, 0x00, op):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
         # abx, aby
         # レジスタの値域解析まではやらないので候補アドレス全てをチェック
         # とりあえずページまたぎ時の dummy read は考慮しない
         # http://wiki.nesdev.com/w/index.php/CPU_addressing_modes
         elif op.mode in (Op.Mode.ABX, Op.Mode.ABY):
-            if all(_access_illegal(db, perms, i, op) for i in _abi_addrs(operand)):
+            if _window_illegal(db, perms, summary, operand, op):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
         # iy
         # ポインタ取得時のページまたぎは wrap around する
         # http://wiki.nesdev.com/w/index.php/CPU_addressing_modes
         elif op.mode is Op.Mode.IY:
             hi = (operand+1) & 0xFF
-            if not perms[operand].readable or not perms[hi].readable:
+            if not perms.readable(operand) or not perms.readable(hi):
                 db.change_analysis(addr, _UNKNOWN, _NOTCODE)
 
     def _analyze_flow(self, db, bank, irq):
@@ -171,84 +480,117 @@ class Analyzer:
         self._analyze_flow_code(db, bank, irq)
 
     def _analyze_flow_unknown(self, db, bank, irq):
-        done = 0x10000 * [False]
+        dec  = bank.decode()
+        done = bytearray(0x10000)
         for addr in range(bank.org, bank.addr_max()+1):
             if not db.is_unknown(addr): continue
             if done[addr]: continue
 
-            self._analyze_flow_unknown_one(db, bank, irq, addr, done, [])
+            self._analyze_flow_unknown_one(db, dec, irq, addr, done)
 
-    def _analyze_flow_unknown_one(self, db, bank, irq, addr, done, trace):
-        # return で探索打ち切り
-        # break でトレースした制御フローを NOTCODE として終了
+    def _analyze_flow_unknown_one(self, db, dec, irq, addr, done):
+        # 2方向分岐の飛び先が両方 UNKNOWN の場合、両方を探索した後で分
+        # 岐元の判定を行う。分岐が密な領域でも再帰が深くならないよう、
+        # 判定待ちの分岐を明示的なスタックで管理する。
+        #
+        # スタックの要素は [分岐元までのトレース, 飛び先, 探索済み飛び先数]
+        forks = []
+
+        trace  = []
+        result = self._flow_unknown_walk(db, dec, irq, addr, done, trace)
         while True:
-            if not bank.addr_contains(addr): return
-            if done[addr]: return
+            if isinstance(result, tuple):
+                forks.append([trace, result, 0])
+            elif result:
+                self._flow_unknown_mark(db, trace)
+
+            # 未探索の飛び先が残っている分岐まで戻る(両方探索済みの分岐
+            # はここで判定する)
+            while forks:
+                fork = forks[-1]
+                if fork[2] < 2: break
+                forks.pop()
+
+                fork_trace, nexts, _ = fork
+                if db.is_notcode(nexts[0]) and db.is_notcode(nexts[1]):
+                    self._flow_unknown_mark(db, fork_trace)
+            else:
+                return
+
+            next_ = fork[1][fork[2]]
+            fork[2] += 1
+
+            trace  = []
+            result = self._flow_unknown_walk(db, dec, irq, next_, done, trace)
+
+    def _flow_unknown_walk(self, db, dec, irq, addr, done, trace):
+        """addr から分岐のない制御フローをたどり、trace に記録する。
+
+        探索打ち切りなら False を、トレースした制御フローを NOTCODE と
+        すべきなら True を返す。飛び先が両方 UNKNOWN の2方向分岐に達し
+        た場合、その飛び先を返す。
+        """
+        while True:
+            if not dec.contains(addr): return False
+            if done[addr]: return False
             done[addr] = True
             trace.append(addr)
 
-            op = Op.get(bank[addr])
             # 命令が尻切れになっていたら探索打ち切り
-            if not bank.addr_contains(addr + op.size - 1): return
+            if dec.is_truncated(addr): return False
 
-            operand = util.unpack_u(bank[addr+1:addr+1+op.argsize]) if op.argsize else None
-            nexts = _op_nexts(addr, op, operand, irq)
+            nexts = dec.nexts(addr, irq)
             # 次の飛び先がなければ探索打ち切り
-            if not nexts: return
+            if not nexts: return False
 
             if len(nexts) == 1:
                 next_ = nexts[0]
                 # 特定不可アドレスはどうしようもないので探索打ち切り
-                if next_ is None: return
+                if next_ is None: return False
 
                 if db.is_unknown(next_):
                     addr = next_ # 探索続行
                 elif db.is_code(next_):
-                    return
+                    return False
                 elif db.is_notcode(next_):
-                    break
+                    return True
             elif len(nexts) == 2:
                 if db.is_unknown(nexts[0]) and db.is_unknown(nexts[1]):
-                    # 両方探索
-                    self._analyze_flow_unknown_one(db, bank, irq, nexts[0], done, [])
-                    self._analyze_flow_unknown_one(db, bank, irq, nexts[1], done, [])
-                    if db.is_notcode(nexts[0]) and db.is_notcode(nexts[1]):
-                        break
-                    return
+                    return nexts # 両方探索
                 elif db.is_code(nexts[0]) or db.is_code(nexts[1]):
-                    return
+                    return False
                 elif db.is_unknown(nexts[0]) and db.is_notcode(nexts[1]):
                     addr = nexts[0] # 探索続行
                 elif db.is_notcode(nexts[0]) and db.is_unknown(nexts[1]):
                     addr = nexts[1] # 探索続行
                 elif db.is_notcode(nexts[0]) and db.is_notcode(nexts[1]):
-                    break
+                    return True
             else:
                 assert False # NOTREACHED
 
+    def _flow_unknown_mark(self, db, trace):
         for addr in trace:
             db.change_analysis(addr, _UNKNOWN, _NOTCODE)
 
     def _analyze_flow_code(self, db, bank, irq):
-        done = 0x10000 * [False]
+        dec  = bank.decode()
+        done = bytearray(0x10000)
         for addr in range(bank.org, bank.addr_max()+1):
             if not db.is_code(addr): continue
             if done[addr]: continue
 
-            self._analyze_flow_code_one(db, bank, irq, addr, done)
+            self._analyze_flow_code_one(db, dec, irq, addr, done)
 
-    def _analyze_flow_code_one(self, db, bank, irq, addr, done):
+    def _analyze_flow_code_one(self, db, dec, irq, addr, done):
         while True:
-            if not bank.addr_contains(addr): return
+            if not dec.contains(addr): return
             if done[addr]: return
             done[addr] = True
 
-            op = Op.get(bank[addr])
             # 命令が尻切れになっていたら探索打ち切り
-            if not bank.addr_contains(addr + op.size - 1): return
+            if dec.is_truncated(addr): return
 
-            operand = util.unpack_u(bank[addr+1:addr+1+op.argsize]) if op.argsize else None
-            nexts = _op_nexts(addr, op, operand, irq)
+            nexts = dec.nexts(addr, irq)
             # 次の飛び先がなければ探索打ち切り
             if not nexts: return
 
@@ -282,16 +624,16 @@ class Analyzer:
         #   * JSR / JMP abs の飛び先(src, dst がともに NOTCODE でないこと)
         # これだと若干誤爆がありうると思うが、問題になるようなら後から
         # 対処を考える
+        dec = bank.decode()
         for addr in range(bank.org, bank.addr_max()-2+1):
             if addr == bank.org and db.is_code(addr):
                 self._autolabel(db, addr)
 
             if db.is_notcode(addr): continue
 
-            op = Op.get(bank[addr])
-            if op.code not in (0x20, 0x4C): continue
+            if dec.opcode(addr) not in (0x20, 0x4C): continue
 
-            dst = util.unpack_u(bank[addr+1:addr+3])
+            dst = dec.operand(addr)
             if not db.is_notcode(dst):
                 self._autolabel(db, dst)
 
@@ -301,5 +643,16 @@ class Analyzer:
         if not label or label.addr != addr:
             name = "L_{:04X}".format(addr)
             db.add_label(name, addr)
+            if self._autolabels is not None:
+                self._autolabels[addr] = name
+
+    def _remove_autolabel(self, db, addr, name):
+        # ユーザが削除/変更していなければ削除
+        try:
+            label = db.get_label(name)
+        except KeyError:
+            return
+        if label.addr == addr and label.size == 1:
+            db.remove_label(name)
 
 
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
 
+import ast
+import codeop
 import enum
+import mmap
+import re
+import struct
+
+from .xref import XrefIndex
+from . import _scriptcache
 
 
 def _chk_addr(addr):
@@ -25,9 +33,19 @@ class DataType(enum.Enum):
     WORD = (2, 2)
 
     def __init__(self, id_, size):
+        self.id_  = id_
         self.size = size
 
 
+# Database 内部では解析結果/データ型をアドレスごとに1バイトのコードで持つ
+_ANALYSIS_BY_CODE  = { a.value : a for a in Analysis }
+_DATA_TYPE_BY_CODE = { t.id_ : t for t in DataType }
+
+_CODE_UNKNOWN = Analysis.UNKNOWN.value
+_CODE_CODE    = Analysis.CODE.value
+_CODE_NOTCODE = Analysis.NOTCODE.value
+
+
 class Label:
     def __init__(self, name, addr, size=1):
         _chk_name(name)
@@ -46,6 +64,18 @@ class Label:
         return self.name < other.name
 
 class _LabelTable:
+    """ラベルテーブル。
+
+    アドレス→ラベルの検索のため、ラベルの範囲を 0x10000 要素のセグメ
+    ント木に登録する。ラベルの追加/削除は O(log n)、アドレスに対応す
+    るラベルの列挙は O(log n + 対応ラベル数) で行える。
+
+    get_label_by_addr() の結果(prefer なしの場合)はアドレスごとにキャッ
+    シュし、ラベル変更時に該当範囲のみ無効化する。
+    """
+
+    _LEAF = 0x10000 # セグメント木の葉の数(葉 addr のノード番号は _LEAF+addr)
+
     def __init__(self):
         self.clear()
 
@@ -67,49 +97,101 @@ class _LabelTable:
 
         ラベルが1つもない場合は None を返す。
         """
-        labels = self._addr_labels[addr]
-        if not labels: return None
-
         if prefer is not None:
-            result = tuple(l for l in labels if l.name == prefer)
+            label = self._name_label.get(prefer)
             # 見つからなくてもエラーにはしない(ラベルテーブル変更時に
             # 整合性を保つのが面倒なので)
-            if result:
-                return result[0]
+            if label and label.addr <= addr < label.addr + label.size:
+                return label
+
+        try:
+            return self._preferred[addr]
+        except KeyError:
+            pass
 
         def prefer_nonarray(label):
             return (0, label) if label.size == 1 else (1, label)
-        result = sorted(labels, key=prefer_nonarray)
-        return result[0]
+        labels = self._find(addr)
+        result = min(labels, key=prefer_nonarray) if labels else None
+
+        self._preferred[addr] = result
+        return result
 
     def get_labels_by_addr(self, addr):
-        return tuple(self._addr_labels[addr])
+        # 登録順に返す
+        return tuple(sorted(self._find(addr), key=lambda label: self._seqs[label.name]))
 
     def add(self, label):
         if self.has_label(label.name):
             self.remove(label.name)
 
         self._name_label[label.name] = label
+        self._seqs[label.name] = self._seq_next
+        self._seq_next += 1
+
+        for node in _LabelTable._nodes(label):
+            self._tree.setdefault(node, []).append(label)
 
-        for addr in label.addrs():
-            self._addr_labels[addr].append(label)
+        self._invalidate(label)
 
     def remove(self, name):
         label = self.get_label(name)
 
-        for addr in label.addrs():
-            labels = self._addr_labels[addr]
-            labels = [l for l in labels if l.name != name]
+        for node in _LabelTable._nodes(label):
+            labels = self._tree[node]
+            labels.remove(label)
+            if not labels: del self._tree[node]
 
         del self._name_label[name]
+        del self._seqs[name]
+
+        self._invalidate(label)
 
     def clear(self):
-        self._name_label  = {}
-        self._addr_labels = [[] for _ in range(0x10000)]
+        self._name_label = {}
+        self._seqs       = {}  # ラベル名 -> 登録順
+        self._seq_next   = 0
+        self._tree       = {}  # ノード番号 -> ラベルのリスト
+        self._preferred  = {}  # アドレス -> get_label_by_addr() の結果
 
     def labels(self):
         return self._name_label.values()
 
+    def _find(self, addr):
+        """addr に対応するラベルを全て返す(順不同)。"""
+        result = []
+        node = _LabelTable._LEAF + addr
+        while node:
+            labels = self._tree.get(node)
+            if labels: result.extend(labels)
+            node >>= 1
+        return result
+
+    def _invalidate(self, label):
+        if label.size <= len(self._preferred):
+            for addr in label.addrs():
+                self._preferred.pop(addr, None)
+        else:
+            for addr in [a for a in self._preferred if label.addr <= a < label.addr + label.size]:
+                del self._preferred[addr]
+
+    @staticmethod
+    def _nodes(label):
+        """label の範囲を覆うセグメント木のノードを返す。"""
+        nodes = []
+        lo = _LabelTable._LEAF + label.addr
+        hi = _LabelTable._LEAF + label.addr + label.size
+        while lo < hi:
+            if lo & 1:
+                nodes.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                nodes.append(hi)
+            lo >>= 1
+            hi >>= 1
+        return nodes
+
 OPERAND_LABEL_AUTO = 1
 OPERAND_LABEL_NONE = 2
 
@@ -118,6 +200,9 @@ class _OperandHint:
         self.disp = 0
         self.name = OPERAND_LABEL_AUTO
 
+# ヒント未設定アドレスの読み取り用(書き換えないこと)
+_OPERAND_HINT_DEFAULT = _OperandHint()
+
 
 class Comment:
     def __init__(self):
@@ -138,12 +223,19 @@ class Comment:
 
     @tail.setter
     def tail(self, str_):
-        if any(c in str_ for c in "\r\n"):
+        if str_ is not None and any(c in str_ for c in "\r\n"):
             raise ValueError("tail comment cannot contain newline chars")
         self._tail = str_
 
     def head_fmt(self, comm_char=";"):
-        lines = self.head.rstrip().splitlines()
+        return Comment.fmt_head(self.head, comm_char)
+
+    def tail_fmt(self, comm_char=";"):
+        return Comment.fmt_tail(self.tail, comm_char)
+
+    @staticmethod
+    def fmt_head(head, comm_char=";"):
+        lines = head.rstrip().splitlines()
 
         if lines:
             return "\n".join(Comment._head_fmt_one(line, comm_char) for line in lines)
@@ -155,11 +247,54 @@ class Comment:
         space_maybe = " " if line else ""
         return comm_char + space_maybe + line
 
-    def tail_fmt(self, comm_char=";"):
-        tail = self.tail.rstrip()
+    @staticmethod
+    def fmt_tail(tail, comm_char=";"):
+        tail = tail.rstrip()
         space_maybe = " " if tail else ""
         return comm_char + space_maybe + tail
 
+class _CommentTable:
+    """アドレスごとのコメントを疎に保持するテーブル。
+
+    comments[addr] は Comment を返す。Comment は初めて参照されたとき
+    に生成される。単に有無を調べたい場合は get() を使うこと(生成を伴
+    わない)。
+    """
+
+    def __init__(self):
+        self._comments = {}
+
+    def __getitem__(self, addr):
+        _chk_addr(addr)
+
+        comm = self._comments.get(addr)
+        if comm is None:
+            comm = self._comments[addr] = Comment()
+        return comm
+
+    def get(self, addr, default=None):
+        return self._comments.get(addr, default)
+
+    def items(self):
+        return sorted(self._comments.items())
+
+
+class Journal:
+    """Database の変更履歴(変更されたアドレスの集合)。
+
+    analysis: 解析結果が設定されたアドレス
+    labels:   ラベルの追加/削除の影響を受けたアドレス
+
+    値が実際に変化したかどうかは問わない。Analyzer.reanalyze() に渡す
+    ためのもの。
+    """
+
+    def __init__(self):
+        self.analysis = set()
+        self.labels   = set()
+
+    def __bool__(self):
+        return bool(self.analysis or self.labels)
 
 class Database:
     def __init__(self, org):
@@ -167,33 +302,68 @@ class Database:
 
         self.org = org
 
-        self.analysis = [Analysis.UNKNOWN for _ in range(0x10000)]
-
-        self.data_types = [DataType.BYTE for _ in range(0x10000)]
+        # アドレスごとの Analysis, DataType のコード
+        self.analysis   = bytearray((_CODE_UNKNOWN,)) * 0x10000
+        self.data_types = bytearray((DataType.BYTE.id_,)) * 0x10000
 
         self._label_table   = _LabelTable()
-        self._operand_hints = tuple(_OperandHint() for _ in range(0x10000))
+        self._operand_hints = {}
+
+        self.comments = _CommentTable()
+
+        # 変更履歴 (Journal)。None なら記録しない
+        self.journal = None
+
+        # 相互参照 (XrefIndex)。必要になったときに作られ、解析結果や
+        # オペランドの指定が変わると破棄される。None なら未作成
+        self.xrefs = None
+
+
+    def start_journal(self):
+        """変更履歴の記録を開始する。"""
+        self.journal = Journal()
+
+    def take_journal(self):
+        """ここまでの変更履歴を返し、新たな記録を開始する。"""
+        journal = self.journal if self.journal is not None else Journal()
+        self.journal = Journal()
+        return journal
 
-        self.comments = [Comment() for _ in range(0x10000)]
 
+    def get_analysis(self, addr):
+        return _ANALYSIS_BY_CODE[self.analysis[addr]]
+
+    def set_analysis(self, addr, analysis, size=1):
+        """addr から size バイトの解析結果を analysis とする。"""
+        _chk_addr(addr)
+        _chk_addr(addr + size - 1)
+        self.analysis[addr:addr+size] = bytes((analysis.value,)) * size
+        self.xrefs = None
+        if self.journal is not None:
+            self.journal.analysis.update(range(addr, addr+size))
 
     def is_unknown(self, addr):
-        return self.analysis[addr] is Analysis.UNKNOWN
+        return self.analysis[addr] == _CODE_UNKNOWN
 
     def is_code(self, addr):
-        return self.analysis[addr] is Analysis.CODE
+        return self.analysis[addr] == _CODE_CODE
 
     def is_notcode(self, addr):
-        return self.analysis[addr] is Analysis.NOTCODE
+        return self.analysis[addr] == _CODE_NOTCODE
 
     def change_analysis(self, addr, from_, to):
-        if self.analysis[addr] is from_:
-            self.analysis[addr] = to
+        if self.analysis[addr] == from_.value:
+            self.analysis[addr] = to.value
+            self.xrefs = None
+            if self.journal is not None:
+                self.journal.analysis.add(addr)
+
+    def get_data_type(self, addr):
+        return _DATA_TYPE_BY_CODE[self.data_types[addr]]
 
     def set_data_type(self, addr, type_):
-        self.data_types[addr] = type_
-        for addr in range(addr, addr + type_.size):
-            self.analysis[addr] = Analysis.NOTCODE
+        self.data_types[addr] = type_.id_
+        self.set_analysis(addr, Analysis.NOTCODE, type_.size)
 
 
     def get_label(self, name):
@@ -205,13 +375,27 @@ class Database:
     def get_labels_by_addr(self, addr):
         return self._label_table.get_labels_by_addr(addr)
 
+    def labels(self):
+        """全ラベルを返す(順不同)。"""
+        return tuple(self._label_table.labels())
+
     def add_label(self, name, addr, size=1):
-        self._label_table.add(Label(name, addr, size))
+        label = Label(name, addr, size)
+        if self.journal is not None:
+            if self._label_table.has_label(name):
+                self.journal.labels.update(self._label_table.get_label(name).addrs())
+            self.journal.labels.update(label.addrs())
+        self._label_table.add(label)
 
     def remove_label(self, name):
+        if self.journal is not None:
+            self.journal.labels.update(self._label_table.get_label(name).addrs())
         self._label_table.remove(name)
 
     def clear_labels(self):
+        if self.journal is not None:
+            for label in self._label_table.labels():
+                self.journal.labels.update(label.addrs())
         self._label_table.clear()
 
 
@@ -227,7 +411,8 @@ class Database:
         この関数でそのような指定ができる。disp はインデックスの値。例
         えば RTS Trick の場合 -1 を指定する。
         """
-        self._operand_hints[addr].disp = disp
+        self._operand_hint_for_write(addr).disp = disp
+        self.xrefs = None
 
     def set_operand_label(self, addr, name):
         """アドレス addr のオペランドに対するラベル名を設定。
@@ -244,7 +429,17 @@ class Database:
 
         name に OPERAND_LABEL_AUTO を指定するとデフォルトの処理となる。
         """
-        self._operand_hints[addr].name = name
+        self._operand_hint_for_write(addr).name = name
+        self.xrefs = None
+
+    def _operand_hint(self, addr):
+        return self._operand_hints.get(addr, _OPERAND_HINT_DEFAULT)
+
+    def _operand_hint_for_write(self, addr):
+        hint = self._operand_hints.get(addr)
+        if hint is None:
+            hint = self._operand_hints[addr] = _OperandHint()
+        return hint
 
     def get_operand_base(self, addr, operand):
         """アドレス addr のオペランドに対するベースアドレスを返す。
@@ -252,7 +447,7 @@ class Database:
         displacement を考慮してベースアドレスを算出する。ベースアドレ
         スが範囲外の値になる場合 operand をそのまま返す。
         """
-        base = operand - self._operand_hints[addr].disp
+        base = operand - self._operand_hint(addr).disp
         if not 0 <= base <= 0xFFFF: # 範囲外になる場合 displacement を無視
             return operand
         else:
@@ -264,15 +459,98 @@ class Database:
         ラベルが見つからないか、OPERAND_LABEL_NONE が指定されている場
         合 None を返す。
         """
-        name = self._operand_hints[addr].name
+        name = self._operand_hint(addr).name
         if name == OPERAND_LABEL_NONE: return None
 
         prefer = name if name != OPERAND_LABEL_AUTO else None
         return self._label_table.get_label_by_addr(operand, prefer)
 
 
-    def apply_script(self, script):
-        DatabaseScript(self).exec_(script)
+    def apply_script(self, script, mode="auto", filename="<script>"):
+        """スクリプトを適用する。mode については DatabaseScript 参照。"""
+        DatabaseScript(self, mode).apply(script, filename)
+
+    def apply_script_file(self, path, mode="auto"):
+        """スクリプトファイルを適用する。mode については DatabaseScript 参照。"""
+        DatabaseScript(self, mode).apply_file(path)
+
+    @staticmethod
+    def is_binary(head):
+        """head (ファイル先頭のバイト列) がバイナリ形式のデータベースかどうかを返す。"""
+        return head[:len(_BIN_MAGIC)] == _BIN_MAGIC
+
+    @staticmethod
+    def load_binary(path):
+        """バイナリ形式のデータベースファイルを読み込み、Database を返す。
+
+        ファイルはメモリマップして読む。
+        """
+        with open(path, "rb") as in_:
+            with mmap.mmap(in_.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _BinReader(buf).read()
+
+    def save_binary(self, out):
+        """バイナリ形式で out (バイナリストリーム) に書き出す。
+
+        形式 (数値は全てリトルエンディアン):
+
+          ヘッダ:   magic "TD6502DB", version (u16), org (u16)
+          セクション: id (4 bytes), 長さ (u32), 内容
+
+        セクションは以下の順に並ぶ:
+
+          ANAL: 解析結果のランレングス符号 ((コード u8, 長さ-1 u16) の列)
+          DTYP: データ型のランレングス符号(同上)
+          LABL: ラベル数 (u32), (addr u16, size u32, 名前) の列
+          HINT: ヒント数 (u32), (addr u16, disp i32, 種別 u8, 名前) の列
+                種別は 0:AUTO, 1:NONE, 2:名前指定(名前は種別 2 の場合のみ)
+          COMM: コメント数 (u32), (addr u16, head, tail) の列
+                head/tail は有無 (u8) に続けて、ありの場合は文字列
+          XREF: 相互参照 (XrefIndex.to_bytes())。xrefs がある場合のみ
+
+        文字列は UTF-8 で、長さ (u32) に続けて格納する。
+        """
+        out.write(_BIN_MAGIC)
+        out.write(struct.pack("<HH", _BIN_VERSION, self.org))
+
+        _bin_section(out, b"ANAL", _rle_encode(self.analysis))
+        _bin_section(out, b"DTYP", _rle_encode(self.data_types))
+
+        buf = bytearray()
+        labels = tuple(self._label_table.labels())
+        buf += struct.pack("<I", len(labels))
+        for label in labels:
+            buf += struct.pack("<HI", label.addr, label.size)
+            buf += _bin_str(label.name)
+        _bin_section(out, b"LABL", buf)
+
+        buf = bytearray()
+        hints = sorted(self._operand_hints.items())
+        buf += struct.pack("<I", len(hints))
+        for addr, hint in hints:
+            if hint.name == OPERAND_LABEL_AUTO:
+                buf += struct.pack("<HiB", addr, hint.disp, 0)
+            elif hint.name == OPERAND_LABEL_NONE:
+                buf += struct.pack("<HiB", addr, hint.disp, 1)
+            else:
+                buf += struct.pack("<HiB", addr, hint.disp, 2)
+                buf += _bin_str(hint.name)
+        _bin_section(out, b"HINT", buf)
+
+        buf = bytearray()
+        comments = self.comments.items()
+        buf += struct.pack("<I", len(comments))
+        for addr, comm in comments:
+            buf += struct.pack("<H", addr)
+            for str_ in (comm.head, comm.tail):
+                if str_ is None:
+                    buf += b"\x00"
+                else:
+                    buf += b"\x01" + _bin_str(str_)
+        _bin_section(out, b"COMM", buf)
+
+        if self.xrefs is not None:
+            _bin_section(out, b"XREF", self.xrefs.to_bytes())
 
     def save_script(self, out):
         out.write("# -*- coding: utf-8 -*-\n")
@@ -281,22 +559,19 @@ class Database:
         out.write("org(0x{:04X})\n".format(self.org))
         out.write("\n")
 
-        for addr in range(0x10000):
-            if self.is_code(addr):
-                out.write("code(0x{:04X})\n".format(addr))
+        for base, size in _runs(self.analysis, _CODE_CODE):
+            out.write(_script_range("code", base, size))
         out.write("\n")
 
-        for region in self._regions_notcode():
-            if region[1] == 1:
-                out.write("notcode(0x{:04X})\n".format(region[0]))
-            else:
-                max_ = region[0] + region[1] - 1
-                out.write("notcode(0x{:04X}, max_=0x{:04X})\n".format(region[0], max_))
+        for base, size in _runs(self.analysis, _CODE_NOTCODE):
+            out.write(_script_range("notcode", base, size))
         out.write("\n")
 
-        for addr, type_ in enumerate(self.data_types):
-            if type_ is not DataType.BYTE:
-                out.write("data(0x{:04X}, type_={})\n".format(addr, type_.name))
+        for base, type_, count in self._regions_data():
+            if count == 1:
+                out.write("data(0x{:04X}, type_={})\n".format(base, type_.name))
+            else:
+                out.write("data(0x{:04X}, type_={}, count={:d})\n".format(base, type_.name, count))
         out.write("\n")
 
         labels = sorted(self._label_table.labels(), key=lambda label: label.addr)
@@ -309,43 +584,198 @@ class Database:
                     repr(label.name), label.addr, label.size))
         out.write("\n")
 
-        for addr, hint in enumerate(self._operand_hints):
+        for addr, hint in sorted(self._operand_hints.items()):
             if hint.disp:
                 out.write("operand_disp(0x{:04X}, {:d})\n".format(addr, hint.disp))
             if hint.name == OPERAND_LABEL_NONE:
-                out.write("operand_label(0x{:04X}, OPERAND_LABEL_NONE)\n")
+                out.write("operand_label(0x{:04X}, OPERAND_LABEL_NONE)\n".format(addr))
             elif hint.name != OPERAND_LABEL_AUTO:
-                out.write("operand_label(0x{:04X}, {}\n".format(addr, repr(hint.name)))
+                out.write("operand_label(0x{:04X}, {})\n".format(addr, repr(hint.name)))
         out.write("\n")
 
-    def _regions_notcode(self):
-        region = [None, 0] # base, size
-        for addr in range(0x10000):
-            if self.is_notcode(addr):
-                if region[0] is None:
-                    region = [addr, 0]
-                region[1] += 1
+    def _regions_data(self):
+        """BYTE 以外のデータ型指定を (base, type_, count) の列として返す。
+
+        同じ型が隙間なく連続している箇所はまとめる。
+        """
+        region = None # [base, type_, count]
+        for m in re.finditer(_RE_NON_BYTE, self.data_types):
+            addr  = m.start()
+            type_ = _DATA_TYPE_BY_CODE[self.data_types[addr]]
+            if region and region[1] is type_ and addr == region[0] + type_.size * region[2]:
+                region[2] += 1
             else:
-                if region[0] is not None:
-                    yield tuple(region)
-                region[0] = None
-        if region[0] is not None:
-            yield tuple(region)
+                if region: yield tuple(region)
+                region = [addr, type_, 1]
+        if region: yield tuple(region)
+
+
+_RE_NON_BYTE = re.compile(b"[^" + re.escape(bytes((DataType.BYTE.id_,))) + b"]")
+
+def _runs(values, code):
+    """values 中で code が連続する箇所を (base, size) の列として返す。"""
+    for m in re.finditer(re.escape(bytes((code,))) + b"+", values):
+        yield m.start(), m.end() - m.start()
+
+def _script_range(func, base, size):
+    if size == 1:
+        return "{}(0x{:04X})\n".format(func, base)
+    else:
+        return "{}(0x{:04X}, max_=0x{:04X})\n".format(func, base, base + size - 1)
+
+
+_BIN_MAGIC   = b"TD6502DB"
+_BIN_VERSION = 1
+
+def _bin_section(out, id_, body):
+    out.write(id_)
+    out.write(struct.pack("<I", len(body)))
+    out.write(body)
+
+def _bin_str(str_):
+    buf = str_.encode("utf-8")
+    return struct.pack("<I", len(buf)) + buf
+
+def _rle_encode(values):
+    buf = bytearray()
+    base = 0
+    while base < len(values):
+        value = values[base]
+        end = base + 1
+        while end < len(values) and values[end] == value:
+            end += 1
+        buf += struct.pack("<BH", value, end - base - 1)
+        base = end
+    return buf
+
+class _BinReader:
+    """バイナリ形式データベースの読み込み。Database.save_binary() 参照。"""
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+
+    def read(self):
+        if not Database.is_binary(self._buf[:len(_BIN_MAGIC)]):
+            raise ValueError("not a td6502 binary database")
+        self._pos = len(_BIN_MAGIC)
+
+        version, org = self._unpack("<HH")
+        if version != _BIN_VERSION:
+            raise ValueError("unsupported database version: {}".format(version))
+        db = Database(org)
+
+        db.analysis   = self._rle_decode(self._section(b"ANAL"))
+        db.data_types = self._rle_decode(self._section(b"DTYP"))
+        if any(c not in _ANALYSIS_BY_CODE for c in set(db.analysis)):
+            raise ValueError("database format error: invalid analysis")
+        if any(c not in _DATA_TYPE_BY_CODE for c in set(db.data_types)):
+            raise ValueError("database format error: invalid data type")
+
+        self._section(b"LABL")
+        count, = self._unpack("<I")
+        for _ in range(count):
+            addr, size = self._unpack("<HI")
+            db.add_label(self._str(), addr, size)
+
+        self._section(b"HINT")
+        count, = self._unpack("<I")
+        for _ in range(count):
+            addr, disp, kind = self._unpack("<HiB")
+            if kind == 0:
+                name = OPERAND_LABEL_AUTO
+            elif kind == 1:
+                name = OPERAND_LABEL_NONE
+            elif kind == 2:
+                name = self._str()
+            else:
+                raise ValueError("database format error: invalid hint")
+            db.set_operand_disp(addr, disp)
+            db.set_operand_label(addr, name)
+
+        self._section(b"COMM")
+        count, = self._unpack("<I")
+        for _ in range(count):
+            addr, = self._unpack("<H")
+            comm = db.comments[addr]
+            if self._unpack("<B")[0]: comm.head = self._str()
+            if self._unpack("<B")[0]: comm.tail = self._str()
+
+        # XREF は省略可能
+        if self._buf[self._pos:self._pos+4] == b"XREF":
+            body = self._section(b"XREF")
+            db.xrefs = XrefIndex.from_bytes(body)
+            self._pos += len(body)
+
+        return db
+
+    def _section(self, id_):
+        """セクションヘッダを読み、セクション内容を返す(読み取り位置は内容の先頭)。"""
+        if self._buf[self._pos:self._pos+4] != id_:
+            raise ValueError("database format error: section {} not found".format(id_.decode()))
+        self._pos += 4
+        size, = self._unpack("<I")
+        if self._pos + size > len(self._buf):
+            raise ValueError("database format error: truncated")
+        return self._buf[self._pos:self._pos+size]
+
+    def _unpack(self, fmt):
+        try:
+            result = struct.unpack_from(fmt, self._buf, self._pos)
+        except struct.error:
+            raise ValueError("database format error: truncated")
+        self._pos += struct.calcsize(fmt)
+        return result
+
+    def _str(self):
+        size, = self._unpack("<I")
+        if self._pos + size > len(self._buf):
+            raise ValueError("database format error: truncated")
+        str_ = str(self._buf[self._pos:self._pos+size], "utf-8")
+        self._pos += size
+        return str_
+
+    def _rle_decode(self, body):
+        if len(body) % struct.calcsize("<BH"):
+            raise ValueError("database format error: invalid run-length data")
+        values = bytearray()
+        for value, run in struct.iter_unpack("<BH", body):
+            values += bytes((value,)) * (run + 1)
+        if len(values) != 0x10000:
+            raise ValueError("database format error: invalid map size")
+        self._pos += len(body)
+        return values
 
 
 class DatabaseScript:
-    def __init__(self, db):
-        self.db = db
+    """データベーススクリプトの実行環境。
+
+    mode はスクリプトの実行方法:
+
+      "parse": 専用パーサで解釈する(exec() を使わない)
+      "exec":  Python コードとして exec() する
+      "auto":  専用パーサで解釈し、扱えない構文があれば exec() する
+    """
+
+    def __init__(self, db, mode="auto"):
+        if mode not in ("auto", "parse", "exec"): raise ValueError("invalid mode: {}".format(mode))
+        self.db   = db
+        self.mode = mode
 
     def org(self, addr):
         _chk_addr(addr)
 
         self.db.org = addr
 
-    def code(self, addr):
-        _chk_addr(addr)
+    def code(self, base, *, max_=None, size=1):
+        _chk_addr(base)
+        if max_ is None:
+            if size < 1: raise ValueError("size must be positive")
+            max_ = base + size - 1
+        _chk_addr(max_)
+        if max_ < base: raise ValueError("max_ < base")
 
-        self.db.analysis[addr] = Analysis.CODE
+        self.db.set_analysis(base, Analysis.CODE, max_ - base + 1)
 
     def notcode(self, base, *, max_=None, size=1):
         _chk_addr(base)
@@ -355,8 +785,7 @@ class DatabaseScript:
         _chk_addr(max_)
         if max_ < base: raise ValueError("max_ < base")
 
-        for addr in range(base, max_+1):
-            self.db.analysis[addr] = Analysis.NOTCODE
+        self.db.set_analysis(base, Analysis.NOTCODE, max_ - base + 1)
 
     def data(self, base, type_=DataType.BYTE, *, max_=None, count=1):
         """NOTCODE 指定およびデータ型の指定。notcode() の上位互換的な関数。"""
@@ -401,26 +830,212 @@ class DatabaseScript:
         self.db.comments[addr].tail = tail
 
     def include(self, path):
+        self.apply_file(path)
+
+    def apply_file(self, path):
+        """mode に応じてスクリプトファイル path を実行する。
+
+        exec() する場合、コンパイル結果をスクリプトと同じディレクトリに
+        キャッシュする (_scriptcache 参照)。auto モードでは、有効なキャッ
+        シュがあるファイルは(以前 exec が必要だったものとして)パーサを
+        通さずに実行する。
+        """
+        if self.mode == "exec":
+            exec(_scriptcache.compile_file(path), self._namespace())
+            return
+
+        if self.mode == "auto":
+            code = _scriptcache.load(path)
+            if code is not None:
+                exec(code, self._namespace())
+                return
+
         with open(path, "r") as in_:
-            exec(in_.read(), self._namespace())
+            script = in_.read()
+
+        if self.mode == "parse":
+            self.parse_(script, path)
+        else:
+            try:
+                self.parse_(script, path)
+            except _ScriptUnsupported:
+                exec(_scriptcache.compile_file(path), self._namespace())
+
+    def apply(self, script, filename="<script>"):
+        """mode に応じて script を実行する。"""
+        if self.mode == "exec":
+            self.exec_(script)
+        elif self.mode == "parse":
+            self.parse_(script, filename)
+        else:
+            # パーサが扱えない構文を含む場合は exec で最初からやり直す
+            # (各関数は冪等なので、途中まで適用済みでも結果は同じ)
+            try:
+                self.parse_(script, filename)
+            except _ScriptUnsupported:
+                self.exec_(script)
 
     def exec_(self, script):
         exec(script, self._namespace())
 
-    def _namespace(self):
-        FUNCS = (
-            "org",
-            "code", "notcode", "data",
-            "label", "operand_disp", "operand_label",
-            "comment_head", "comment_tail",
-            "include",
-        )
+    def parse_(self, script, filename="<script>"):
+        """script を exec() を使わずに解釈し、1文ずつ適用する。
+
+        受け付けるのは関数呼び出しの文のみで、引数はリテラルと定数名
+        (BYTE, WORD, OPERAND_LABEL_AUTO, OPERAND_LABEL_NONE) に限る。
+        save_script() の出力の各行は正規表現で直接解釈し、それ以外の行
+        (複数行にわたる文字列など)は ast で解釈する。
 
-        ns = { name : getattr(self, name) for name in FUNCS }
+        エラーは ScriptError (ファイル名と行番号付き) として送出する。
+        受け付けない構文を含む場合は _ScriptUnsupported を送出する。
+        """
+        funcs = { name : getattr(self, name) for name in DatabaseScript._FUNCS }
+
+        lines = script.splitlines()
+        i = 0
+        while i < len(lines):
+            lineno = i + 1
+            line = lines[i].strip()
+            i += 1
+            if not line or line.startswith("#"): continue
+
+            call = _parse_simple_call(line)
+            if call:
+                calls = (call,)
+            else:
+                text = lines[i-1]
+                while True:
+                    try:
+                        code = codeop.compile_command(text, filename, "exec")
+                    except SyntaxError as e:
+                        raise ScriptError(filename, lineno, e.msg)
+                    if code is not None: break
+                    if i >= len(lines):
+                        raise ScriptError(filename, lineno, "unexpected EOF")
+                    text += "\n" + lines[i]
+                    i += 1
+                calls = _parse_calls(text, filename, lineno)
+
+            for name, args, kwargs in calls:
+                func = funcs.get(name)
+                if func is None:
+                    raise _ScriptUnsupported(filename, lineno, "unknown function: {}".format(name))
+                try:
+                    func(*args, **kwargs)
+                except ScriptError:
+                    raise
+                except Exception as e:
+                    raise ScriptError(filename, lineno, "{}: {}".format(type(e).__name__, e)) from e
+
+    _FUNCS = (
+        "org",
+        "code", "notcode", "data",
+        "label", "operand_disp", "operand_label",
+        "comment_head", "comment_tail",
+        "include",
+    )
 
-        ns["BYTE"] = DataType.BYTE
-        ns["WORD"] = DataType.WORD
-        ns["OPERAND_LABEL_AUTO"] = OPERAND_LABEL_AUTO
-        ns["OPERAND_LABEL_NONE"] = OPERAND_LABEL_NONE
+    def _namespace(self):
+        ns = { name : getattr(self, name) for name in DatabaseScript._FUNCS }
+        ns.update(_SCRIPT_CONSTS)
 
         return ns
+
+
+class ScriptError(Exception):
+    """データベーススクリプトの解釈/実行エラー。"""
+
+    def __init__(self, filename, lineno, msg):
+        super().__init__("{}:{}: {}".format(filename, lineno, msg))
+        self.filename = filename
+        self.lineno   = lineno
+
+class _ScriptUnsupported(ScriptError):
+    """パーサが扱えない構文(exec が必要)。"""
+
+
+_SCRIPT_CONSTS = {
+    "BYTE" : DataType.BYTE,
+    "WORD" : DataType.WORD,
+    "OPERAND_LABEL_AUTO" : OPERAND_LABEL_AUTO,
+    "OPERAND_LABEL_NONE" : OPERAND_LABEL_NONE,
+}
+
+_RE_SIMPLE_CALL = re.compile(r"([A-Za-z_]\w*)\(([^()#\\]*)\)")
+_RE_SIMPLE_STR  = re.compile(r"""(['"])(\w*)\1""")
+_RE_SIMPLE_KW   = re.compile(r"([A-Za-z_]\w*)\s*=([^=].*)")
+
+def _parse_simple_call(line):
+    """"func(arg, ..., key=arg, ...)" 形式の行を解釈する。
+
+    引数は整数、識別子のみからなる文字列、定数名に限る。解釈できなけ
+    れば None を返す(ast による解釈に回す)。
+    """
+    m = _RE_SIMPLE_CALL.fullmatch(line)
+    if not m: return None
+
+    name, args_str = m.groups()
+    args   = []
+    kwargs = {}
+    if args_str.strip():
+        for arg in args_str.split(","):
+            key = None
+            m = _RE_SIMPLE_KW.fullmatch(arg.strip())
+            if m:
+                key, arg = m.groups()
+            arg = arg.strip()
+
+            if arg in _SCRIPT_CONSTS:
+                value = _SCRIPT_CONSTS[arg]
+            elif arg[:1] in ("'", '"'):
+                m = _RE_SIMPLE_STR.fullmatch(arg)
+                if not m: return None
+                value = m.group(2)
+            else:
+                try:
+                    value = int(arg, 0)
+                except ValueError:
+                    return None
+
+            if key is None:
+                if kwargs: return None
+                args.append(value)
+            else:
+                if key in kwargs: return None
+                kwargs[key] = value
+
+    return name, args, kwargs
+
+def _parse_calls(text, filename, lineno):
+    """text (1つ以上の完結した文) を ast で解釈し、(関数名, 引数, キーワー
+    ド引数) の列を返す。
+    """
+    try:
+        module = ast.parse(text, filename)
+    except SyntaxError as e:
+        raise ScriptError(filename, lineno, e.msg)
+
+    def value(node):
+        if isinstance(node, ast.Name):
+            if node.id not in _SCRIPT_CONSTS:
+                raise _ScriptUnsupported(filename, lineno, "unknown name: {}".format(node.id))
+            return _SCRIPT_CONSTS[node.id]
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            raise _ScriptUnsupported(filename, lineno, "not a literal")
+
+    calls = []
+    for stmt in module.body:
+        if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) and
+                isinstance(stmt.value.func, ast.Name)):
+            raise _ScriptUnsupported(filename, lineno + stmt.lineno - 1, "not a function call")
+        call = stmt.value
+        if any(isinstance(arg, ast.Starred) for arg in call.args) or\
+           any(kw.arg is None for kw in call.keywords):
+            raise _ScriptUnsupported(filename, lineno + stmt.lineno - 1, "argument unpacking")
+
+        args   = [value(arg) for arg in call.args]
+        kwargs = { kw.arg : value(kw.value) for kw in call.keywords }
+        calls.append((call.func.id, args, kwargs))
+    return calls
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+
+import array
+
+from .op import Op
+from . import util
+
+
+# nexts の特殊値
+NEXT_UNKNOWN = -1 # 飛び先が特定できない
+_NEXT_IRQ    = -2 # IRQ アドレス(問い合わせ時に置き換える)
+
+
+def _op_nexts(addr, op, operand):
+    """命令 op 実行後の飛び先の候補を全て返す。候補数は 0,1,2 のいずれか。
+
+    候補数1の場合のみ飛び先が特定できないことがある。その場合飛び先を
+    NEXT_UNKNOWN で表す。BRK の飛び先は _NEXT_IRQ で表す。
+    """
+    # KIL
+    if op.code in (0x02, 0x12, 0x22, 0x32, 0x42, 0x52, 0x62, 0x72, 0x92, 0xB2, 0xD2, 0xF2):
+        return ()
+    # BRK
+    elif op.code == 0x00:
+        return (_NEXT_IRQ,)
+    # JSR, JMP abs
+    elif op.code in (0x20, 0x4C):
+        return (operand,)
+    # JMP ind, RTS, RTI
+    elif op.code in (0x6C, 0x60, 0x40):
+        return (NEXT_UNKNOWN,)
+    # 分岐命令
+    elif op.mode is Op.Mode.REL:
+        after  = addr + 2
+        target = addr + 2 + util.u8_to_s8(operand)
+
+        # アドレス空間内で wrap around するケースはどう扱うべきか判然
+        # としないので、とりあえず飛び先なしとして判定を打ち切る
+        if after > 0xFFFF or target < 0 or target > 0xFFFF:
+            return ()
+
+        return tuple({ after, target }) # 一致するケースがありうるので
+    # その他
+    else:
+        after = addr + op.size
+
+        # アドレス空間内で wrap around するケースはどう扱うべきか判然
+        # としないので、とりあえず飛び先なしとして判定を打ち切る
+        if after > 0xFFFF:
+            return ()
+
+        return (after,)
+
+
+class DecodedBank:
+    """バンク内の全アドレスを命令先頭とみなしてデコードした結果。
+
+    各解析パスおよび逆アセンブラが同じアドレスを何度もデコードしない
+    よう、以下をアドレスごとの並列配列として一度だけ計算しておく:
+
+      * オペコード
+      * 命令サイズ
+      * 尻切れ(命令末尾がバンク外)かどうか
+      * オペランド値(オペランドなし、または尻切れの場合 -1)
+      * 命令実行後の飛び先候補(尻切れの場合は候補なし)
+
+    通常は Bank.decode() 経由で取得する。
+    """
+
+    def __init__(self, bank):
+        self.org      = bank.org
+        self.addr_max = bank.addr_max()
+
+        n = len(bank)
+        body = bytes(bank.view())
+
+        self.opcodes     = body
+        self.sizes       = bytearray(n)
+        self.truncated   = bytearray(n)
+        self.operands    = array.array("l", (-1,)) * n
+        self.next_counts = bytearray(n)
+        self.nexts0      = array.array("l", (NEXT_UNKNOWN,)) * n
+        self.nexts1      = array.array("l", (NEXT_UNKNOWN,)) * n
+
+        for i in range(n):
+            addr = self.org + i
+            op   = Op.get(body[i])
+
+            self.sizes[i] = op.size
+            if i + op.size > n:
+                self.truncated[i] = 1
+                continue
+
+            if op.argsize == 1:
+                operand = body[i+1]
+            elif op.argsize == 2:
+                operand = body[i+1] | (body[i+2] << 8)
+            else:
+                operand = None
+            if operand is not None:
+                self.operands[i] = operand
+
+            nexts = _op_nexts(addr, op, operand)
+            self.next_counts[i] = len(nexts)
+            if len(nexts) >= 1: self.nexts0[i] = nexts[0]
+            if len(nexts) >= 2: self.nexts1[i] = nexts[1]
+
+    def contains(self, addr):
+        return self.org <= addr <= self.addr_max
+
+    def opcode(self, addr):
+        return self.opcodes[addr - self.org]
+
+    def op(self, addr):
+        return Op.get(self.opcodes[addr - self.org])
+
+    def size(self, addr):
+        return self.sizes[addr - self.org]
+
+    def is_truncated(self, addr):
+        return bool(self.truncated[addr - self.org])
+
+    def operand(self, addr):
+        """オペランド値を返す。オペランドがない、または尻切れの場合 None。"""
+        operand = self.operands[addr - self.org]
+        return None if operand < 0 else operand
+
+    def nexts(self, addr, irq):
+        """命令実行後の飛び先候補を返す。候補数は 0,1,2 のいずれか。
+
+        候補数1の場合のみ飛び先が特定できないことがある。その場合飛び
+        先を None で表す(irq が None の場合の BRK も同様)。
+        """
+        i = addr - self.org
+        count = self.next_counts[i]
+        if count == 0:
+            return ()
+        elif count == 1:
+            next_ = self.nexts0[i]
+            if next_ == _NEXT_IRQ: next_ = irq
+            elif next_ == NEXT_UNKNOWN: next_ = None
+            return (next_,)
+        else:
+            return (self.nexts0[i], self.nexts1[i])
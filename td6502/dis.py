@@ -1,50 +1,239 @@
 # -*- coding: utf-8 -*-
 
 
+import collections
+import concurrent.futures
+import json
+import re
+
 from .op import Op
-from .db import DataType
+from .db import DataType, Comment
+from .xref import XrefIndex, access_str
 from . import util
 
 
+# 16進文字列テーブル(4桁のものは大きいので初回使用時に作る)
+_HEX2 = tuple("{:02X}".format(i) for i in range(0x100))
+_HEX4 = None
+
+def _hex4(value):
+    global _HEX4
+    if _HEX4 is None:
+        _HEX4 = tuple("{:04X}".format(i) for i in range(0x10000))
+    return _HEX4[value]
+
 def _hex_dollar(value, size):
-    fmt = "${{:0{}X}}".format(2 * size)
-    return fmt.format(value)
+    if size == 1 and 0 <= value <= 0xFF:
+        return "$" + _HEX2[value]
+    elif size == 2 and 0 <= value <= 0xFFFF:
+        return "$" + _hex4(value)
+    else:
+        fmt = "${{:0{}X}}".format(2 * size)
+        return fmt.format(value)
 
 def _disp_str(disp):
     return "{:+d}".format(disp) if disp else ""
 
+# コメント未設定アドレス用
+_COMMENT_EMPTY = Comment()
+
+def _tail_str(tail):
+    return " " + Comment.fmt_tail(tail) + "\n" if tail is not None else " ;\n"
+
+
+# MD6502Dis.iter_lines() の要素
+
+# 空行(addr は直後の要素のアドレス)
+Separator = collections.namedtuple("Separator", ("addr",))
+
+# 行頭コメント(text は生のコメント文字列)
+HeadComment = collections.namedtuple("HeadComment", ("addr", "text"))
+
+LabelLine = collections.namedtuple("LabelLine", ("addr", "name"))
+
+class CodeLine(collections.namedtuple("CodeLine", ("addr", "op", "operand", "mnemonic", "tail"))):
+    """命令行。operand はオペランド値(なければ None)、tail は行末コメント(なければ None)。"""
+
+    __slots__ = ()
+
+    @property
+    def raw(self):
+        if self.operand is None: return bytes((self.op.code,))
+        return bytes((self.op.code,)) + util.pack_u(self.operand, self.op.argsize)
+
+class DataLine(collections.namedtuple("DataLine", ("addr", "type_", "value", "mnemonic", "tail"))):
+    """データ行。tail は行末コメント(なければ None)。"""
+
+    __slots__ = ()
+
+    @property
+    def raw(self):
+        return util.pack_u(self.value, self.type_.size)
+
+# コード終端要素 (JMP abs / JMP ind / RTI / RTS)
+_EXITPOINTS = frozenset((0x4C, 0x6C, 0x40, 0x60))
+
 def _operand(addr, operand):
     return operand
 
 
+class _OpFmt:
+    """命令ごとの出力テンプレート。
+
+    raw:    オペコードのダンプ ("A9" など)
+    prefix: ニーモニック+空白 ("lda " など)
+    pre, post: オペランドの前後に付く文字列 ("#", "" など)
+    """
+
+    __slots__ = ("raw", "prefix", "pre", "post")
+
+    def __init__(self, op, fmt):
+        self.raw    = _HEX2[op.code]
+        self.prefix = op.name + " "
+        self.pre, self.post = fmt.split("{}") if fmt else ("", "")
+
+
+_FMTS = {
+    Op.Mode.NONE : "",
+    Op.Mode.IM   : "#{}",
+    Op.Mode.ZP   : "{}",
+    Op.Mode.ZPX  : "{},x",
+    Op.Mode.ZPY  : "{},y",
+    Op.Mode.AB   : "{}",
+    Op.Mode.ABX  : "{},x",
+    Op.Mode.ABY  : "{},y",
+    Op.Mode.IX   : "({},x)",
+    Op.Mode.IY   : "({}),y",
+    Op.Mode.REL  : "{}",
+    Op.Mode.IND  : "({})",
+    Op.Mode.BRK  : "#{}",
+}
+
+_OP_FMTS = tuple(_OpFmt(Op.get(code), _FMTS[Op.get(code).mode]) for code in range(0x100))
+
+
 class MD6502Dis:
-    _FMTS = {
-        Op.Mode.NONE : "",
-        Op.Mode.IM   : "#{}",
-        Op.Mode.ZP   : "{}",
-        Op.Mode.ZPX  : "{},x",
-        Op.Mode.ZPY  : "{},y",
-        Op.Mode.AB   : "{}",
-        Op.Mode.ABX  : "{},x",
-        Op.Mode.ABY  : "{},y",
-        Op.Mode.IX   : "({},x)",
-        Op.Mode.IY   : "({}),y",
-        Op.Mode.REL  : "{}",
-        Op.Mode.IND  : "({})",
-        Op.Mode.BRK  : "#{}",
-    }
+    # 出力はこの命令/データ数ごとにまとめて書き出す
+    CHUNK_LINES = 2048
 
-    def __init__(self):
-        pass
+    # 行末の相互参照コメントに並べる参照元の最大数
+    XREF_TAIL_MAX = 8
+
+    def __init__(self, xref=False):
+        """xref: 参照されている行の行末コメントに参照元を付記する"""
+        self.xref = xref
+
+    def dis(self, db, bank, out, start=None, end=None, index=None, jobs=1):
+        """逆アセンブル結果を out (テキストストリーム) に書き出す。
+
+        jobs > 1 の場合、jobs 個のプロセスで並列に整形する(結果は同じ)。
+        """
+        for chunk in self._dis_chunks_jobs(db, bank, start, end, index, jobs):
+            out.write(chunk)
+
+    def dis_binary(self, db, bank, out, encoding="utf-8", errors="strict",
+                   start=None, end=None, index=None, jobs=1):
+        """逆アセンブル結果をエンコードして out (バイナリストリーム) に書き出す。
+
+        テキストレイヤを経由しないので、大きな出力をパイプに流す場合に
+        速い。改行コードの変換は行わない。
+        """
+        for chunk in self._dis_chunks_jobs(db, bank, start, end, index, jobs):
+            out.write(chunk.encode(encoding, errors))
+
+    def _dis_chunks_jobs(self, db, bank, start, end, index, jobs):
+        if jobs <= 1:
+            return self._dis_chunks(db, bank, start, end, index)
+        else:
+            return self._dis_chunks_parallel(db, bank, start, end, index, jobs)
+
+    def _dis_chunks_parallel(self, db, bank, start, end, index, jobs):
+        """範囲を分割し、プロセスプールで並列に逆アセンブルする。
+
+        iter_lines() は要素をアドレスで選別するので、範囲を重ならない
+        ように分割して結果を順に連結すれば逐次版と同じ出力になる。各範
+        囲の先頭での空行挿入判定の状態は BoundaryIndex から得る。
+        """
+        if start is None: start = bank.org
+        if end   is None: end   = bank.addr_max() + 1
+        if index is None: index = BoundaryIndex.build(self, db, bank)
+        if self.xref: self.xrefs(db, bank) # 各プロセスで作らないよう事前に
+
+        # 負荷の偏りをならすため、プロセス数より多めに分割する
+        n = 4 * jobs
+        edges = [start + (end - start) * i // n for i in range(n + 1)]
+        ranges = [(lo, hi) for lo, hi in zip(edges, edges[1:]) if lo < hi]
+
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_dis_worker_init,
+                                                    initargs=(self, db, bank, index)) as pool:
+            yield from pool.map(_dis_worker, ranges)
+
+    def _dis_chunks(self, db, bank, start, end, index):
+        """逆アセンブル結果を CHUNK_LINES 行程度ずつの文字列として返す。"""
+        buf    = []
+        nlines = 0
+
+        for line in self.iter_lines(db, bank, start, end, index):
+            buf.append(self._format(line))
+
+            if isinstance(line, (CodeLine, DataLine)):
+                nlines += 1
+                if nlines >= self.CHUNK_LINES:
+                    yield "".join(buf)
+                    buf    = []
+                    nlines = 0
+
+        if buf:
+            yield "".join(buf)
+
+    def _format(self, line):
+        """iter_lines() の要素をテキストに整形する。"""
+        type_ = type(line)
+        if type_ is CodeLine:
+            return _hex4(line.addr) + " : " + self._dump_op(line.op, line.operand).ljust(12) +\
+                   line.mnemonic.ljust(20) + _tail_str(line.tail)
+        elif type_ is DataLine:
+            # WORD はオペランド部を 10 桁に揃える
+            mne = line.mnemonic.ljust(13) if line.type_ is DataType.WORD else line.mnemonic
+            return _hex4(line.addr) + " : " + mne + _tail_str(line.tail)
+        elif type_ is LabelLine:
+            return line.name + ":\n"
+        elif type_ is HeadComment:
+            return Comment.fmt_head(line.text) + "\n"
+        elif type_ is Separator:
+            return "\n\n"
+        else:
+            assert False # NOTREACHED
+
+    def iter_lines(self, db, bank, start=None, end=None, index=None):
+        """逆アセンブル結果を構造化された行の列として返す。
+
+        要素は Separator, HeadComment, LabelLine, CodeLine, DataLine の
+        いずれか。start, end を指定した場合、アドレスが [start, end) の
+        要素のみを返す。
+
+        命令境界の判定はバンク先頭から行うが、index (BoundaryIndex) を
+        与えた場合は start 以降の最初の境界から始める(結果は同じ)。
+        """
+        if start is None: start = bank.org
+        if end   is None: end   = bank.addr_max() + 1
 
-    def dis(self, db, bank, out):
         prev_code      = False
         prev_data      = False
         prev_exitpoint = False
 
+        dec = bank.decode()
+
+        xrefs = self.xrefs(db, bank) if self.xref else None
+
         addr = bank.org
-        while bank.addr_contains(addr):
-            code = self._is_code(db, bank, addr)
+        if index is not None and start > bank.org:
+            found = index.seek(start)
+            if found is None: return
+            addr, prev_code, prev_data, prev_exitpoint = found
+        while bank.addr_contains(addr) and addr < end:
+            code = self._is_code(db, dec, addr)
+            emit = addr >= start
 
             # ラベル取得(配列ラベルの場合、開始点のみ)
             label = db.get_label_by_addr(addr)
@@ -62,88 +251,107 @@ class MD6502Dis:
             # で多少の誤りは許容する方向で。
             if (code and prev_data) or (not code and prev_code) or\
                (prev_exitpoint and label) or (prev_data and label):
-                out.write("\n\n")
+                if emit: yield Separator(addr)
+
+            comm = db.comments.get(addr, _COMMENT_EMPTY)
+            if emit and comm.head is not None:
+                yield HeadComment(addr, comm.head)
 
-            comm = db.comments[addr]
-            if comm.head is not None:
-                out.write(comm.head_fmt())
-                out.write("\n")
+            if emit and label:
+                yield LabelLine(addr, label.name)
 
-            if label:
-                out.write("{}:\n".format(label.name))
+            tail = comm.tail
 
             if code:
-                op = Op.get(bank[addr])
-                operand = util.unpack_u(bank[addr+1:addr+1+op.argsize]) if op.argsize else None
-                self._dis_code(db, addr, op, operand, out)
+                op = dec.op(addr)
+                if emit:
+                    operand = dec.operand(addr)
+                    if xrefs: tail = self._xref_tail(xrefs, addr, op.size, tail)
+                    yield CodeLine(addr, op, operand, self._mnemonic(db, addr, op, operand), tail)
 
                 next_ = addr + op.size
-                prev_exitpoint = op.code in (0x4C, 0x6C, 0x40, 0x60)
+                prev_exitpoint = op.code in _EXITPOINTS
             else:
-                data_type = db.data_types[addr]
+                data_type = db.get_data_type(addr)
                 data_size = data_type.size
 
                 # 尻切れになる場合は Byte 単位で出力
                 if not bank.addr_contains(addr + data_size - 1):
+                    data_type = DataType.BYTE
                     data_size = 1
-                    self._dis_data_byte(db, addr, bank[addr], out)
-                else:
-                    data_buf = bank[addr:addr+data_size]
-                    self._dis_data(db, addr, data_type, data_buf, out)
+
+                if emit:
+                    value = bank.read_u16(addr) if data_size == 2 else bank.read_u8(addr)
+                    mne = self._dis_data(db, addr, data_type, value)
+                    if xrefs: tail = self._xref_tail(xrefs, addr, data_size, tail)
+                    yield DataLine(addr, data_type, value, mne, tail)
 
                 next_ = addr + data_size
                 prev_exitpoint = False
 
-            out.write(" ")
-            out.write(comm.tail_fmt() if comm.tail is not None else ";")
-            out.write("\n")
-
             addr = next_
             prev_code = code
             prev_data = not code
 
-    def _is_code(self, db, bank, addr):
+    def xrefs(self, db, bank):
+        """db の相互参照を返す。なければ(もしくは bank 用でなければ)作って db に設定する。"""
+        if db.xrefs is None or not db.xrefs.matches(bank):
+            db.xrefs = XrefIndex.build(self, db, bank)
+        return db.xrefs
+
+    def _xref_tail(self, xrefs, addr, size, tail):
+        """行 [addr, addr+size) への参照元を行末コメント tail に付記する。"""
+        refs = xrefs.refs_to_range(addr, size)
+        if not refs: return tail
+
+        strs = []
+        for target, src, access in refs[:self.XREF_TAIL_MAX]:
+            str_ = _hex4(src) + " " + access_str(access)
+            if target != addr: str_ += " +{:d}".format(target - addr)
+            strs.append(str_)
+        if len(refs) > self.XREF_TAIL_MAX:
+            strs.append("... (+{:d})".format(len(refs) - self.XREF_TAIL_MAX))
+
+        text = "xref: " + ", ".join(strs)
+        return text if tail is None else tail + " " + text
+
+    def _is_code(self, db, dec, addr):
         """コードとして出力すべきかどうかの判定。"""
-        op = Op.get(bank[addr])
-
         # コードとして解釈すると尻切れになる場合データとする
-        if not bank.addr_contains(addr + op.size - 1): return False
+        if dec.is_truncated(addr): return False
 
         # CODE 指定されていればコード
         if db.is_code(addr): return True
 
         # UNKNOWN の場合、official 命令ならコード
-        if db.is_unknown(addr) and op.official: return True
+        if db.is_unknown(addr) and dec.op(addr).official: return True
 
         # その他の場合データとする
         return False
 
-    def _dis_code(self, db, addr, op, operand, out):
-        raw = self._dump_op(op, operand)
-        mne = self._mnemonic(db, addr, op, operand)
-
-        out.write("{:04X} : {:<12}{:<20}".format(addr, raw, mne))
-
     def _dump_op(self, op, operand):
-        buf = bytes((op.code,))
-        if op.argsize:
-            buf += util.pack_u(operand, op.argsize)
-        return " ".join("{:02X}".format(b) for b in buf)
+        raw = _OP_FMTS[op.code].raw
+        if op.argsize == 1:
+            return raw + " " + _HEX2[operand]
+        elif op.argsize == 2:
+            return raw + " " + _HEX2[operand & 0xFF] + " " + _HEX2[operand >> 8]
+        else:
+            return raw
 
     def _mnemonic(self, db, addr, op, operand):
-        fmt = MD6502Dis._FMTS[op.mode]
+        fmt = _OP_FMTS[op.code]
 
-        if op.mode is Op.Mode.REL:
+        if op.mode is Op.Mode.NONE:
+            return op.name
+        elif op.mode is Op.Mode.REL:
             value      = util.rel_target(addr, operand)
             value_size = 2
         else:
             value      = operand
             value_size = op.argsize
 
-        if op.mode is Op.Mode.NONE:
-            mne_operand = ""
-        elif op.mode in (Op.Mode.IM, Op.Mode.BRK):
-            mne_operand = fmt.format(_hex_dollar(value, value_size))
+        if op.mode in (Op.Mode.IM, Op.Mode.BRK):
+            value_str = _hex_dollar(value, value_size)
         else:
             base  = db.get_operand_base (addr, value)
             label = db.get_operand_label(addr, base)
@@ -158,23 +366,21 @@ class MD6502Dis:
 
             base_str = label.name if label else _hex_dollar(base, value_size)
             value_str = base_str + _disp_str(disp)
-            mne_operand = fmt.format(value_str)
 
-        return op.name + (" " + mne_operand if mne_operand else "")
+        return fmt.prefix + fmt.pre + value_str + fmt.post
 
     def _operand_str(self, addr, operand):
         pass
 
-    def _dis_data(self, db, addr, type_, buf, out):
+    def _dis_data(self, db, addr, type_, value):
         if type_ is DataType.BYTE:
-            self._dis_data_byte(db, addr, buf[0], out)
+            return self._dis_data_byte(db, addr, value)
         elif type_ is DataType.WORD:
-            value = util.unpack_u(buf)
-            self._dis_data_word(db, addr, value, out)
+            return self._dis_data_word(db, addr, value)
         else:
             assert False # NOTREACHED
 
-    def _dis_data_word(self, db, addr, value, out):
+    def _dis_data_word(self, db, addr, value):
         base  = db.get_operand_base (addr, value)
         label = db.get_operand_label(addr, base)
 
@@ -190,10 +396,166 @@ class MD6502Dis:
         base_str = label.name if label else _hex_dollar(base, 2)
         value_str = base_str + _disp_str(disp)
 
-        out.write("{:04X} : dw {:<10}".format(addr, value_str))
+        return "dw " + value_str
 
-    def _dis_data_byte(self, db, addr, value, out):
+    def _dis_data_byte(self, db, addr, value):
         # BYTE の場合は displacement やラベルは考慮しない
-        out.write("{:04X} : db ${:02X}".format(addr, value))
+        return "db $" + _HEX2[value]
+
+
+# 並列逆アセンブル用ワーカープロセスの状態
+_worker = None
+
+def _dis_worker_init(dis, db, bank, index):
+    global _worker
+    _worker = (dis, db, bank, index)
+
+def _dis_worker(range_):
+    dis, db, bank, index = _worker
+    return "".join(dis._dis_chunks(db, bank, range_[0], range_[1], index))
+
+
+class BoundaryIndex:
+    """逆アセンブル時の行(命令/データ)境界のインデックス。
+
+    バンク内の各アドレスについて、行の先頭かどうかと、そこでの空行挿
+    入判定の状態 (直前の行がコードか/データか/コード終端要素か) を持
+    つ。これを使うとバンク先頭から辿らずに途中から逆アセンブルできる。
+
+    インデックスは構築時のデータベースとバンクに対してのみ有効。
+    """
+
+    _LINE      = 1
+    _CODE      = 2
+    _DATA      = 4
+    _EXITPOINT = 8
+
+    _RE_LINE = re.compile(b"[^\\x00]")
+
+    def __init__(self, org, states):
+        self.org    = org
+        self.states = states
+
+    @classmethod
+    def build(cls, dis, db, bank):
+        """dis (MD6502Dis) と同じ境界判定でインデックスを作る。"""
+        states = bytearray(len(bank))
+        dec    = bank.decode()
+
+        state = cls._LINE
+        addr  = bank.org
+        while bank.addr_contains(addr):
+            states[addr - bank.org] = state
+
+            if dis._is_code(db, dec, addr):
+                op = dec.op(addr)
+                addr += op.size
+                state = cls._LINE | cls._CODE
+                if op.code in _EXITPOINTS: state |= cls._EXITPOINT
+            else:
+                data_size = db.get_data_type(addr).size
+                if not bank.addr_contains(addr + data_size - 1):
+                    data_size = 1
+                addr += data_size
+                state = cls._LINE | cls._DATA
+
+        return cls(bank.org, states)
+
+    def update(self, dis, db, bank, addrs):
+        """addrs (解析結果またはデータ型が変わったアドレス) の変更を反映する。
+
+        行の判定はその先頭アドレスのみに依存するので、変更のあった行先
+        頭から辿り直し、元のインデックスと同じ状態の行先頭に達した時点
+        で打ち切る。状態が変わりうる範囲 [lo, hi) のリストを返す。
+        """
+        states = self.states
+        org    = self.org
+        end    = bank.addr_max() + 1
+        dec    = bank.decode()
+
+        pending = sorted(addr for addr in addrs if bank.addr_contains(addr))
+        ranges  = []
+        i = 0
+        while i < len(pending):
+            addr = pending[i]
+            i += 1
+            if not states[addr - org]: continue # 行の途中(境界がずれなければ無関係)
+
+            lo = addr
+            while True:
+                if dis._is_code(db, dec, addr):
+                    op = dec.op(addr)
+                    next_ = addr + op.size
+                    state = self._LINE | self._CODE
+                    if op.code in _EXITPOINTS: state |= self._EXITPOINT
+                else:
+                    data_size = db.get_data_type(addr).size
+                    if not bank.addr_contains(addr + data_size - 1):
+                        data_size = 1
+                    next_ = addr + data_size
+                    state = self._LINE | self._DATA
+
+                states[addr+1-org:next_-org] = bytes(next_ - addr - 1)
+                addr = next_
+
+                # 辿った範囲内の変更は処理済み
+                while i < len(pending) and pending[i] < addr:
+                    i += 1
+
+                if addr >= end: break
+                if states[addr - org] == state: break # 元と一致(以降は残りの変更から)
+                states[addr - org] = state
+
+            ranges.append((lo, addr))
+
+        return ranges
+
+    def seek(self, addr):
+        """addr 以降の最初の行境界を探す。
+
+        (アドレス, prev_code, prev_data, prev_exitpoint) を返す。見つか
+        らなければ None。
+        """
+        m = BoundaryIndex._RE_LINE.search(self.states, max(addr - self.org, 0))
+        if not m: return None
+
+        pos   = m.start()
+        state = self.states[pos]
+        return (self.org + pos,
+                bool(state & BoundaryIndex._CODE),
+                bool(state & BoundaryIndex._DATA),
+                bool(state & BoundaryIndex._EXITPOINT))
+
+    def to_bytes(self):
+        return util.pack_u(self.org, 2) + bytes(self.states)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        if len(buf) < 3: raise ValueError("index too short")
+        return cls(util.unpack_u(buf[:2]), bytearray(buf[2:]))
+
+
+class JsonLinesDis(MD6502Dis):
+    """iter_lines() の各要素を JSON Lines として出力する。"""
+
+    _TYPES = {
+        CodeLine    : "code",
+        DataLine    : "data",
+        LabelLine   : "label",
+        HeadComment : "comment",
+        Separator   : "separator",
+    }
+
+    def _format(self, line):
+        obj = { "type" : JsonLinesDis._TYPES[type(line)], "addr" : line.addr }
 
+        if isinstance(line, (CodeLine, DataLine)):
+            obj["bytes"]    = list(line.raw)
+            obj["mnemonic"] = line.mnemonic
+            obj["comment"]  = line.tail
+        elif isinstance(line, LabelLine):
+            obj["name"] = line.name
+        elif isinstance(line, HeadComment):
+            obj["text"] = line.text
 
+        return json.dumps(obj, ensure_ascii=False) + "\n"
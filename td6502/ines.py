@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""iNES / NES 2.0 形式の ROM イメージ。
+
+PRG ROM をマッパーに応じたサイズのバンクに分割し、それぞれをコピーせ
+ずに Bank として取り出せる。
+"""
+
+
+from . import Bank
+
+
+HEADER_SIZE  = 16
+TRAINER_SIZE = 512
+
+_MAGIC = b"NES\x1A"
+
+# マッパー番号 -> (バンクサイズ, バンク配置)
+#
+#   "fixed":  PRG ROM 全体を $10000 の手前に置く (NROM など)
+#   "last":   最終バンクを $10000 の手前、他を $8000 に置く
+#   "last2":  最後の2バンクを $C000, $E000、他を $8000 に置く (MMC3)
+#   "switch": 全バンクを $8000 に置く
+#
+# 表にないマッパーは 16KB 単位 "last" とする(UxROM, MMC1 など多くの
+# マッパーがこれに該当する)。
+_LAYOUTS = {
+    0   : (0x8000, "fixed"),  # NROM
+    3   : (0x8000, "fixed"),  # CNROM
+    7   : (0x8000, "switch"), # AxROM
+    11  : (0x8000, "switch"), # Color Dreams
+    34  : (0x8000, "switch"), # BNROM
+    66  : (0x8000, "switch"), # GxROM
+    4   : (0x2000, "last2"),  # MMC3
+    118 : (0x2000, "last2"),  # TxSROM
+    119 : (0x2000, "last2"),  # TQROM
+}
+_LAYOUT_DEFAULT = (0x4000, "last")
+
+
+def is_ines(head):
+    return bytes(head[:4]) == _MAGIC
+
+
+class INes:
+    """iNES / NES 2.0 形式の ROM イメージ。
+
+    buf は bytes, mmap など buffer protocol をサポートするもの。PRG ROM
+    はコピーせずに参照する。
+    """
+
+    def __init__(self, buf):
+        view = memoryview(buf).cast("B")
+        if len(view) < HEADER_SIZE or not is_ines(view): raise ValueError("not an iNES file")
+
+        flags6 = view[6]
+        flags7 = view[7]
+
+        self.nes2   = (flags7 & 0x0C) == 0x08
+        self.mapper = (flags6 >> 4) | (flags7 & 0xF0)
+
+        prg_units = view[4]
+        if self.nes2:
+            self.mapper |= (view[8] & 0x0F) << 8
+            prg_hi = view[9] & 0x0F
+            if prg_hi == 0x0F: raise ValueError("exponent-multiplier PRG ROM size not supported")
+            prg_units |= prg_hi << 8
+        prg_size = 0x4000 * prg_units
+        if not prg_size: raise ValueError("PRG ROM empty")
+
+        # PRG ROM のファイル内オフセット(トレーナーがあればその直後)
+        self.prg_offset = HEADER_SIZE + (TRAINER_SIZE if flags6 & (1<<2) else 0)
+        if self.prg_offset + prg_size > len(view): raise ValueError("PRG ROM truncated")
+        self.prg = view[self.prg_offset:self.prg_offset+prg_size]
+
+        bank_size, self._layout = _LAYOUTS.get(self.mapper, _LAYOUT_DEFAULT)
+        self.bank_size = min(bank_size, prg_size)
+
+    def bank_count(self):
+        return len(self.prg) // self.bank_size
+
+    def bank_offset(self, i):
+        """バンク i の PRG ROM 内オフセット(FCEUX CDL ファイル内のオフセットでもある)。"""
+        self._chk_bank(i)
+        return self.bank_size * i
+
+    def default_org(self, i):
+        """マッパーに基づくバンク i の既定の配置アドレス。"""
+        self._chk_bank(i)
+        n = self.bank_count()
+
+        if self._layout == "fixed":
+            return 0x10000 - self.bank_size
+        elif self._layout == "last":
+            return 0x10000 - self.bank_size if i == n-1 else 0x8000
+        elif self._layout == "last2":
+            if i == n-1: return 0xE000
+            if i == n-2: return 0xC000
+            return 0x8000
+        elif self._layout == "switch":
+            return 0x8000
+        else:
+            assert False # NOTREACHED
+
+    def bank(self, i, org=None):
+        """バンク i を Bank として返す。org 省略時は default_org(i)。"""
+        if org is None: org = self.default_org(i)
+        offset = self.bank_offset(i)
+        return Bank(self.prg[offset:offset+self.bank_size], org)
+
+    def _chk_bank(self, i):
+        if not 0 <= i < self.bank_count(): raise ValueError("bank out of range")
@@ -33,6 +33,21 @@ class Plugin:
 
         self.instance.update_perms(perms)
 
+    @staticmethod
+    def source_path(identifier):
+        """identifier のプラグインのソースファイルのパスを返す(ロードはしない)。
+
+        見つからなければ None。
+        """
+        if os.path.isfile(identifier): return os.path.abspath(identifier)
+
+        relative = "..{}.{}".format(_PLUGIN_PACKAGE, identifier)
+        try:
+            spec = importlib.util.find_spec(relative, __name__)
+        except Exception:
+            return None
+        return spec.origin if spec else None
+
     # importlib の使い方はイマイチ自信なし。一応動いてるっぽいけど
 
     @staticmethod
@@ -51,48 +51,26 @@ class _Nes:
 
     def update_perms(self, perms):
         # RAM mirror is not accessible
-        for i in range(0x0800, 0x1FFF+1):
-            perms[i].readable   = False
-            perms[i].writable   = False
-            perms[i].executable = False
+        perms.set_range(0x0800, 0x1FFF, readable=False, writable=False, executable=False)
 
         # I/O registers are not executable
-        for i in range(0x2000, 0x4017+1):
-            perms[i].executable = False
+        perms.set_range(0x2000, 0x4017, executable=False)
 
         # PPU register mirror is not accessible
-        for i in range(0x2008, 0x3FFF+1):
-            perms[i].readable = False
-            perms[i].writable = False
+        perms.set_range(0x2008, 0x3FFF, readable=False, writable=False)
 
         # write-only registers
-        perms[0x2000].readable = False
-        perms[0x2001].readable = False
-        perms[0x2003].readable = False
-        perms[0x2005].readable = False
-        perms[0x2006].readable = False
-        perms[0x4000].readable = False
-        perms[0x4001].readable = False
-        perms[0x4002].readable = False
-        perms[0x4003].readable = False
-        perms[0x4004].readable = False
-        perms[0x4005].readable = False
-        perms[0x4006].readable = False
-        perms[0x4007].readable = False
-        perms[0x4008].readable = False
-        perms[0x400A].readable = False
-        perms[0x400B].readable = False
-        perms[0x400C].readable = False
-        perms[0x400E].readable = False
-        perms[0x400F].readable = False
-        perms[0x4010].readable = False
-        perms[0x4011].readable = False
-        perms[0x4012].readable = False
-        perms[0x4013].readable = False
-        perms[0x4014].readable = False
+        perms.set(0x2000, readable=False)
+        perms.set(0x2001, readable=False)
+        perms.set(0x2003, readable=False)
+        perms.set(0x2005, readable=False)
+        perms.set(0x2006, readable=False)
+        perms.set_range(0x4000, 0x4008, readable=False)
+        perms.set_range(0x400A, 0x400C, readable=False)
+        perms.set_range(0x400E, 0x4014, readable=False)
 
         # read-only registers
-        perms[0x2002].writable = False
+        perms.set(0x2002, writable=False)
 
         # $4009 and $400D are unused, but eventually accessed in memory-clearing loops
         # http://wiki.nesdev.com/w/index.php/2A03
@@ -21,10 +21,6 @@ class _NesMapper0:
     def update_ops_valid(self, ops_valid): pass
 
     def update_perms(self, perms):
-        for i in range(0x4018, 0x7FFF+1):
-            perms[i].readable   = False
-            perms[i].writable   = False
-            perms[i].executable = False
+        perms.set_range(0x4018, 0x7FFF, readable=False, writable=False, executable=False)
 
-        for i in range(0x8000, 0xFFFF+1):
-            perms[i].writable = False
+        perms.set_range(0x8000, 0xFFFF, writable=False)
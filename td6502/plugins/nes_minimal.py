@@ -40,39 +40,17 @@ class _NesMinimal:
 
     def update_perms(self, perms):
         # I/O registers are not executable
-        for i in range(0x2000, 0x4017+1):
-            perms[i].executable = False
+        perms.set_range(0x2000, 0x4017, executable=False)
 
         # write-only registers
-        for i in range(0x2000, 0x3FFF+1, 8):
-            perms[i+0].readable = False
-            perms[i+1].readable = False
-            perms[i+3].readable = False
-            perms[i+5].readable = False
-            perms[i+6].readable = False
-        perms[0x4000].readable = False
-        perms[0x4001].readable = False
-        perms[0x4002].readable = False
-        perms[0x4003].readable = False
-        perms[0x4004].readable = False
-        perms[0x4005].readable = False
-        perms[0x4006].readable = False
-        perms[0x4007].readable = False
-        perms[0x4008].readable = False
-        perms[0x400A].readable = False
-        perms[0x400B].readable = False
-        perms[0x400C].readable = False
-        perms[0x400E].readable = False
-        perms[0x400F].readable = False
-        perms[0x4010].readable = False
-        perms[0x4011].readable = False
-        perms[0x4012].readable = False
-        perms[0x4013].readable = False
-        perms[0x4014].readable = False
+        for i in (0, 1, 3, 5, 6):
+            perms.set_range(0x2000+i, 0x3FFF, step=8, readable=False)
+        perms.set_range(0x4000, 0x4008, readable=False)
+        perms.set_range(0x400A, 0x400C, readable=False)
+        perms.set_range(0x400E, 0x4014, readable=False)
 
         # read-only registers
-        for i in range(0x2000, 0x3FFF+1, 8):
-            perms[i+2].writable = False
+        perms.set_range(0x2002, 0x3FFF, step=8, writable=False)
 
         # $4009 and $400D are unused, but eventually accessed in memory-clearing loops
         # http://wiki.nesdev.com/w/index.php/2A03
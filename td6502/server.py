@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""常駐して Bank, Database を保持し、JSON-RPC で操作/問い合わせを受け付
+けるサーバ (td6502-server)。
+
+Unix ドメインソケット上で、1行1メッセージの JSON-RPC 2.0 を話す。
+
+メソッド:
+
+  label(name, addr, size=1)          ラベル追加
+  remove_label(name)                 ラベル削除
+  code(addr, size=1)                 CODE 指定
+  notcode(addr, size=1)              NOTCODE 指定
+  unknown(addr, size=1)              UNKNOWN 指定
+  comment(addr, head=null, tail=null) コメント設定 (null なら削除)
+  reanalyze()                        変更を解析に反映し、影響を受けたアドレス数を返す
+  disassemble(start=null, end=null, fmt="md6502")
+                                     範囲 [start, end) の逆アセンブル結果
+                                     (fmt="jsonl" なら行オブジェクトのリスト)
+  xrefs(addr, size=1)                [addr, addr+size) への参照の
+                                     [参照先, 参照元, 種別 ("read/write" など)] のリスト
+  save(path, binary=false)           データベースを保存
+  shutdown()                         サーバ終了
+
+変更は reanalyze() を呼ぶか、次に disassemble() を呼んだときに差分解
+析 (Analyzer.reanalyze()) で反映される。逆アセンブル結果は REGION_SIZE
+バイト単位の領域ごとにキャッシュし、変更の影響を受けた領域のみ作り
+直す。
+"""
+
+
+import os
+import json
+import inspect
+import socketserver
+
+from .op import Op
+from .db import Analysis
+from .dis import MD6502Dis, JsonLinesDis, BoundaryIndex
+from .xref import access_str
+from . import util
+
+
+REGION_SIZE = 0x100
+
+# JSON-RPC 2.0 のエラーコード
+_PARSE_ERROR      = -32700
+_INVALID_REQUEST  = -32600
+_METHOD_NOT_FOUND = -32601
+_INVALID_PARAMS   = -32602
+_SERVER_ERROR     = -32000
+
+
+class Session:
+    """サーバが保持する解析対象と、逆アセンブル結果のキャッシュ。
+
+    db, bank は解析済みで、analyzer はそれを解析したもの
+    (reanalyze() 可能であること)。
+    """
+
+    def __init__(self, db, bank, analyzer):
+        self.db       = db
+        self.bank     = bank
+        self.analyzer = analyzer
+
+        self.dis = MD6502Dis()
+
+        self.index   = BoundaryIndex.build(self.dis, db, bank)
+        self.regions = {} # 領域番号 -> テキスト
+
+        self._refs  = self._build_refs()
+        self._xrefs = None # 最後に sync() した状態に対する XrefIndex (作成済みなら)
+
+        self.shutdown_requested = False
+
+        db.start_journal()
+
+    METHODS = ("label", "remove_label", "code", "notcode", "unknown", "comment",
+               "reanalyze", "disassemble", "xrefs", "save", "shutdown")
+
+    def method(self, name):
+        """RPC メソッド name の関数。なければ None。"""
+        if name not in Session.METHODS: return None
+        return getattr(self, "rpc_" + name)
+
+
+    def rpc_label(self, name, addr, size=1):
+        self.db.add_label(name, addr, size)
+
+    def rpc_remove_label(self, name):
+        self.db.remove_label(name)
+
+    def rpc_code(self, addr, size=1):
+        self.db.set_analysis(addr, Analysis.CODE, size)
+
+    def rpc_notcode(self, addr, size=1):
+        self.db.set_analysis(addr, Analysis.NOTCODE, size)
+
+    def rpc_unknown(self, addr, size=1):
+        self.db.set_analysis(addr, Analysis.UNKNOWN, size)
+
+    def rpc_comment(self, addr, head=None, tail=None):
+        if not 0 <= addr <= 0xFFFF: raise ValueError("addr out of range")
+        comm = self.db.comments[addr]
+        comm.head = head
+        comm.tail = tail
+        self._invalidate((addr,))
+
+    def rpc_reanalyze(self):
+        return len(self.sync())
+
+    def rpc_disassemble(self, start=None, end=None, fmt="md6502"):
+        self.sync()
+
+        bank = self.bank
+        if start is None: start = bank.org
+        if end   is None: end   = bank.addr_max() + 1
+        start = max(start, bank.org)
+        end   = min(end, bank.addr_max() + 1)
+        if start >= end: return [] if fmt == "jsonl" else ""
+
+        if fmt == "jsonl":
+            dis = JsonLinesDis()
+            return [json.loads(dis._format(line))
+                    for line in dis.iter_lines(self.db, bank, start, end, self.index)]
+        elif fmt != "md6502":
+            raise ValueError("unknown format: {}".format(fmt))
+
+        # 領域をまたぐ部分はキャッシュを使い、端の半端な部分は直接作る
+        buf = []
+        region_lo = -(-start // REGION_SIZE)
+        region_hi = end // REGION_SIZE
+        if region_lo >= region_hi:
+            return self._dis(start, end)
+
+        buf.append(self._dis(start, region_lo * REGION_SIZE))
+        for region in range(region_lo, region_hi):
+            buf.append(self._region(region))
+        buf.append(self._dis(region_hi * REGION_SIZE, end))
+        return "".join(buf)
+
+    def rpc_xrefs(self, addr, size=1):
+        if not 0 <= addr <= 0xFFFF: raise ValueError("addr out of range")
+        self.sync()
+        xrefs = self._xrefs = self.dis.xrefs(self.db, self.bank)
+        return [[target, src, access_str(access)]
+                for target, src, access in xrefs.refs_to_range(addr, size)]
+
+    def rpc_save(self, path, binary=False):
+        if binary:
+            self.dis.xrefs(self.db, self.bank)
+            with open(path, "wb") as out:
+                self.db.save_binary(out)
+        else:
+            with open(path, "w") as out:
+                self.db.save_script(out)
+
+    def rpc_shutdown(self):
+        self.shutdown_requested = True
+
+
+    def sync(self):
+        """未反映の変更を差分解析し、影響を受けた領域のキャッシュを捨てる。
+
+        影響を受けたアドレスの集合を返す。
+        """
+        changes = self.db.take_journal()
+        if not changes: return set()
+
+        affected = self.analyzer.reanalyze(self.db, self.bank, changes)
+        affected |= changes.analysis | changes.labels
+
+        # 行境界(およびその直前の行の種別)が変わった領域
+        ranges  = self.index.update(self.dis, self.db, self.bank, changes.analysis | affected)
+        regions = set()
+        for lo, hi in ranges:
+            regions.update(range(lo // REGION_SIZE, (hi-1) // REGION_SIZE + 1))
+        self._invalidate_regions(regions)
+
+        # 相互参照は行境界の変わった範囲の命令からの参照のみ作り直す
+        if self._xrefs is not None:
+            self._xrefs = self.db.xrefs = self._xrefs.update(self.dis, self.db, self.bank, ranges)
+
+        # 変化したアドレス自身と、そこをオペランドで参照している箇所
+        # (ラベル名が変わりうる)
+        addrs = set(affected)
+        for addr in affected:
+            addrs.update(self._refs.get(addr, ()))
+        self._invalidate(addrs)
+
+        return affected
+
+    def _build_refs(self):
+        """オペランド(命令、WORD データとして解釈した場合)のベースアドレス
+        -> 参照元アドレス。ラベル変更時のキャッシュ無効化に使う。
+        """
+        db   = self.db
+        bank = self.bank
+        dec  = bank.decode()
+        refs = {}
+        for addr in range(bank.org, bank.addr_max()+1):
+            values = []
+            operand = dec.operand(addr)
+            if operand is not None:
+                op = dec.op(addr)
+                if op.mode is Op.Mode.REL:
+                    operand = util.rel_target(addr, operand)
+                values.append(operand)
+            if bank.addr_contains(addr+1):
+                values.append(bank.read_u16(addr))
+            for value in values:
+                refs.setdefault(db.get_operand_base(addr, value), []).append(addr)
+        return refs
+
+    def _invalidate(self, addrs):
+        self._invalidate_regions(set(addr // REGION_SIZE for addr in addrs))
+
+    def _invalidate_regions(self, regions):
+        for region in regions:
+            self.regions.pop(region, None)
+
+    def _region(self, region):
+        text = self.regions.get(region)
+        if text is None:
+            lo = region * REGION_SIZE
+            text = self.regions[region] = self._dis(lo, lo + REGION_SIZE)
+        return text
+
+    def _dis(self, start, end):
+        if start >= end: return ""
+        return "".join(self.dis._dis_chunks(self.db, self.bank, start, end, self.index))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            response = self.server.dispatch(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            if self.server.session.shutdown_requested:
+                break
+
+class Server(socketserver.UnixStreamServer):
+    """Session を JSON-RPC で公開する Unix ドメインソケットサーバ。
+
+    接続は1つずつ順に処理する(Session は排他制御をしていないため)。
+    """
+
+    def __init__(self, path, session):
+        self.session = session
+        super().__init__(path, _Handler)
+
+    def dispatch(self, line):
+        """1リクエストを処理し、レスポンス (通知の場合 None) を返す。"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return _error(None, _PARSE_ERROR, str(e))
+
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error(None, _INVALID_REQUEST, "invalid request")
+
+        id_    = request.get("id")
+        params = request.get("params", [])
+        if not isinstance(params, (list, dict)):
+            return _error(id_, _INVALID_PARAMS, "params must be array or object")
+
+        response = self._call(id_, request["method"], params)
+        return response if "id" in request else None
+
+    def _call(self, id_, method, params):
+        func = self.session.method(method)
+        if func is None:
+            return _error(id_, _METHOD_NOT_FOUND, "method not found: {}".format(method))
+
+        args, kwargs = (params, {}) if isinstance(params, list) else ((), params)
+        try:
+            inspect.signature(func).bind(*args, **kwargs)
+        except TypeError as e:
+            return _error(id_, _INVALID_PARAMS, str(e))
+
+        # 引数の型の誤りなども含め、メソッド内のエラーはサーバエラーとする
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            return _error(id_, _SERVER_ERROR, "{}: {}".format(type(e).__name__, e))
+        return { "jsonrpc" : "2.0", "id" : id_, "result" : result }
+
+    def serve(self):
+        """shutdown() が呼ばれるまでリクエストを処理する。"""
+        try:
+            while not self.session.shutdown_requested:
+                self.handle_request()
+        finally:
+            self.server_close()
+            try:
+                os.remove(self.server_address)
+            except OSError:
+                pass
+
+def _error(id_, code, message):
+    return { "jsonrpc" : "2.0", "id" : id_, "error" : { "code" : code, "message" : message } }
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""バンク番号付きのアドレス空間。
+
+バンク切り替えのある ROM では、同じ CPU アドレスが複数のバンクに対応
+する。ここではバンク番号と CPU アドレスの組を 24bit のリニアアドレス
+(bank << 16 | addr) で表し、全バンクを1プロセスで扱えるようにする。
+
+文字列表現は "BB:AAAA" (いずれも16進)。
+"""
+
+
+import os.path
+import json
+
+from .db import Database
+from .ines import INes
+
+
+BANK_MAX = 0xFF
+
+
+def linear(bank, addr):
+    """(バンク番号, CPU アドレス) をリニアアドレスにする。"""
+    if not 0 <= bank <= BANK_MAX: raise ValueError("bank out of range")
+    if not 0 <= addr <= 0xFFFF: raise ValueError("addr out of range")
+    return (bank << 16) | addr
+
+def split(linear_):
+    """リニアアドレスを (バンク番号, CPU アドレス) にする。"""
+    if not 0 <= linear_ <= (BANK_MAX << 16 | 0xFFFF): raise ValueError("linear address out of range")
+    return linear_ >> 16, linear_ & 0xFFFF
+
+def linear_str(linear_):
+    return "{:02X}:{:04X}".format(*split(linear_))
+
+def parse(str_):
+    """"BB:AAAA" (linear_str() の形式) または CPU アドレス (int(str_, 0)
+    で解釈できるもの) を (バンク番号, CPU アドレス) にする。
+
+    バンク番号がなければ None。解釈できなければ ValueError。
+    """
+    if ":" in str_:
+        bank_str, addr_str = str_.split(":", 1)
+        try:
+            bank, addr = int(bank_str, 16), int(addr_str, 16)
+        except ValueError:
+            raise ValueError("invalid address: {}".format(str_))
+        linear(bank, addr) # 範囲チェック
+        return bank, addr
+
+    try:
+        addr = int(str_, base=0)
+    except ValueError:
+        raise ValueError("invalid address: {}".format(str_))
+    if not 0 <= addr <= 0xFFFF: raise ValueError("addr out of range")
+    return None, addr
+
+
+class BankedSpace:
+    """バンク番号 -> (Bank, Database) の表。
+
+    Database は初回アクセス時に作る(既存のものを set_db() で与えても
+    よい)。触れていないバンクのデータベースはメモリを消費しない。
+    """
+
+    def __init__(self):
+        self._banks = {}
+        self._dbs   = {}
+
+    @classmethod
+    def from_project(cls, out_dir):
+        """td6502-project の出力ディレクトリ(summary.json とバンクごとの
+        データベース)から作る。
+
+        解析に成功した iNES のバンクのみを PRG バンク番号で登録する(生
+        の PRG ダンプから切り出したバンクは番号がないので含まない)。
+        """
+        with open(os.path.join(out_dir, "summary.json"), "r") as in_:
+            summaries = json.load(in_)
+
+        space = cls()
+        roms  = {} # パス -> INes
+        for summary in summaries:
+            if summary.get("status") != "ok" or summary.get("prg_bank") is None: continue
+
+            path = summary["file"]
+            if path not in roms:
+                with open(path, "rb") as in_:
+                    roms[path] = INes(in_.read())
+
+            number = summary["prg_bank"]
+            space.add_bank(number, roms[path].bank(number, summary["org"]))
+            space.set_db(number, _load_db(os.path.join(out_dir, os.path.basename(summary["db"]))))
+
+        return space
+
+    def add_bank(self, number, bank):
+        if not 0 <= number <= BANK_MAX: raise ValueError("bank out of range")
+        if number in self._banks: raise ValueError("bank already exists: {}".format(number))
+        self._banks[number] = bank
+
+    def numbers(self):
+        return sorted(self._banks)
+
+    def bank(self, number):
+        return self._banks[number]
+
+    def db(self, number):
+        db = self._dbs.get(number)
+        if db is None:
+            db = Database(self._banks[number].org)
+            self._dbs[number] = db
+        return db
+
+    def set_db(self, number, db):
+        if number not in self._banks: raise KeyError(number)
+        if db.org != self._banks[number].org: raise ValueError("org mismatch")
+        self._dbs[number] = db
+
+    def has_db(self, number):
+        return number in self._dbs
+
+    def resolve(self, linear_):
+        """リニアアドレスを (Bank, Database, CPU アドレス) にする。
+
+        バンクがない、もしくはアドレスがバンク外なら KeyError。
+        """
+        number, addr = split(linear_)
+        bank = self._banks.get(number)
+        if bank is None or not bank.addr_contains(addr): raise KeyError(linear_str(linear_))
+        return bank, self.db(number), addr
+
+    def find(self, addr):
+        """CPU アドレス addr を含むバンクのリニアアドレスを全て返す。"""
+        return [linear(n, addr) for n in self.numbers() if self._banks[n].addr_contains(addr)]
+
+    def get_label(self, name):
+        """名前 name のラベルを持つバンクを探し、(バンク番号, Label) を返す。
+
+        データベースを作成済みのバンクのみ探す。なければ KeyError。
+        """
+        for number in sorted(self._dbs):
+            try:
+                return number, self._dbs[number].get_label(name)
+            except KeyError:
+                pass
+        raise KeyError(name)
+
+    def get_label_by_linear(self, linear_):
+        number, addr = split(linear_)
+        if number not in self._dbs: return None
+        return self._dbs[number].get_label_by_addr(addr)
+
+
+def _load_db(path):
+    with open(path, "rb") as in_:
+        head = in_.read(16)
+    if Database.is_binary(head):
+        return Database.load_binary(path)
+
+    db = Database(0)
+    db.apply_script_file(path)
+    return db
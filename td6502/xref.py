@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""相互参照 (どの命令がどのアドレスを参照しているか) のインデックス。"""
+
+
+import array
+import bisect
+import collections
+import enum
+import hashlib
+import itertools
+import struct
+
+from .op import Op
+from . import util
+
+
+class Access(enum.IntFlag):
+    """参照の種別。1つの参照が複数の種別を持つことがある(RMW 命令など)。
+
+    IX, IY, IND の READ/WRITE はポインタ自体に対するアクセス (Op と同
+    じ)。
+    """
+    READ     = 1 << 0
+    WRITE    = 1 << 1
+    EXEC     = 1 << 2 # 飛び先として参照 (JUMP, CALL, BRANCH)
+    JUMP     = 1 << 3
+    CALL     = 1 << 4
+    BRANCH   = 1 << 5
+    INDIRECT = 1 << 6 # オペランドがポインタ
+
+_ACCESS_NAMES = tuple((a, a.name.lower()) for a in Access)
+
+def access_str(access):
+    """種別を "read/write" のような文字列にする。"""
+    return "/".join(name for a, name in _ACCESS_NAMES if access & a)
+
+def access_parse(str_):
+    """access_str() の逆。"""
+    access = Access(0)
+    for name in str_.split("/"):
+        try:
+            access |= Access[name.upper()]
+        except KeyError:
+            raise ValueError("invalid access kind: {}".format(name))
+    return access
+
+
+def op_access(op):
+    """命令 op のオペランドの参照種別。参照しない命令なら 0。"""
+    if op.mode in (Op.Mode.NONE, Op.Mode.IM, Op.Mode.BRK):
+        return Access(0)
+
+    if op.mode is Op.Mode.REL:
+        return Access.EXEC | Access.BRANCH
+    if op.code == 0x20:
+        return Access.EXEC | Access.CALL
+    if op.code == 0x4C:
+        return Access.EXEC | Access.JUMP
+    if op.code == 0x6C:
+        return Access.READ | Access.JUMP | Access.INDIRECT
+
+    access = Access(0)
+    if op.argread:  access |= Access.READ
+    if op.argwrite: access |= Access.WRITE
+    if op.mode in (Op.Mode.IX, Op.Mode.IY): access |= Access.INDIRECT
+    return access
+
+# build() 用(IntFlag の演算は遅いので int で持つ)
+_OP_ACCESS = tuple(int(op_access(Op.get(code))) for code in range(0x100))
+_BRANCH    = int(Access.BRANCH)
+
+
+class XrefIndex:
+    """参照先アドレス -> (参照元アドレス, 種別) の列。
+
+    参照元は逆アセンブル結果でコードとして出力される命令。参照先はオ
+    ペランドのベースアドレス (Database.get_operand_base()) で、インデッ
+    クス修飾は考慮しない。
+
+    参照先ごとに連続した配列 (CSR 形式) で持つので、refs_to() は参照数
+    に比例する時間で済む。参照元アドレス順に並ぶ。
+
+    インデックスは構築時のデータベースとバンクに対してのみ有効。バン
+    クのダイジェストを持つので、別のバンクに対して使われることはない。
+    データベース側は、解析結果やオペランドの指定が変わると
+    Database.xrefs が破棄される。
+    """
+
+    def __init__(self, digest, targets, sources, kinds):
+        """digest はバンクのダイジェスト (bank_digest())。
+
+        targets, sources, kinds は参照ごとの並列配列 (targets 順に整列済み)。
+        """
+        if not (len(targets) == len(sources) == len(kinds)): raise ValueError("array length mismatch")
+
+        self.digest = digest
+
+        self._targets = targets
+        self._sources = sources
+        self._kinds   = kinds
+
+        if list(targets) != sorted(targets): raise ValueError("targets not sorted")
+
+        # 参照先ごとの開始位置
+        counts = [0] * 0x10001
+        for target, count in collections.Counter(targets).items():
+            counts[target+1] = count
+        self._offsets = array.array("L", itertools.accumulate(counts))
+
+    @classmethod
+    def build(cls, dis, db, bank):
+        """dis (MD6502Dis) がコードとして出力する命令から作る。"""
+        refs = _walk(dis, db, bank, bank.org, bank.addr_max() + 1)
+        refs.sort(key=lambda ref: ref[0]) # 安定ソートなので参照元アドレス順は保たれる
+        return cls(bank_digest(bank),
+                   array.array("H", (ref[0] for ref in refs)),
+                   array.array("H", (ref[1] for ref in refs)),
+                   bytes(ref[2] for ref in refs))
+
+    def update(self, dis, db, bank, ranges):
+        """ranges 内の命令からの参照を作り直したものを返す。
+
+        ranges は行境界が変わりうる範囲 [lo, hi) のリスト
+        (BoundaryIndex.update() の結果)。lo は行の先頭であること。
+        """
+        drop = bytearray(0x10000)
+        for lo, hi in ranges:
+            drop[lo:hi] = b"\x01" * (hi - lo)
+
+        targets = array.array("H", self._targets)
+        sources = array.array("H", self._sources)
+        kinds   = bytearray(self._kinds)
+        for i in reversed([i for i, source in enumerate(sources) if drop[source]]):
+            del targets[i], sources[i], kinds[i]
+
+        # 参照先ごとに参照元アドレス順となる位置に挿入
+        for lo, hi in ranges:
+            for target, source, access in _walk(dis, db, bank, lo, hi):
+                i = bisect.bisect_left(targets, target)
+                i = bisect.bisect_left(sources, source, i, bisect.bisect_right(targets, target, i))
+                targets.insert(i, target)
+                sources.insert(i, source)
+                kinds.insert(i, access)
+
+        return XrefIndex(self.digest, targets, sources, bytes(kinds))
+
+    def matches(self, bank):
+        """bank に対して構築したものかどうか。"""
+        return self.digest == bank_digest(bank)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def refs_to(self, addr):
+        """addr を参照する (参照元アドレス, Access) のリスト。"""
+        lo, hi = self._offsets[addr], self._offsets[addr+1]
+        return [(self._sources[i], Access(self._kinds[i])) for i in range(lo, hi)]
+
+    def refs_to_range(self, addr, size):
+        """[addr, addr+size) を参照する (参照先, 参照元, Access) のリスト。"""
+        end = min(addr + size, 0x10000)
+        lo, hi = self._offsets[addr], self._offsets[end]
+        return [(self._targets[i], self._sources[i], Access(self._kinds[i])) for i in range(lo, hi)]
+
+    def count_to(self, addr):
+        return self._offsets[addr+1] - self._offsets[addr]
+
+    def targets(self):
+        """参照されているアドレスを昇順に返す。"""
+        return sorted(set(self._targets))
+
+    def to_bytes(self):
+        """バンクのダイジェスト (20バイト), 参照数 (u32) に続けて、参照先
+        (u16), 参照元 (u16), 種別 (u8) の配列を並べたもの。
+        """
+        buf = bytearray(_HEADER.pack(self.digest, len(self)))
+        for arr in (self._targets, self._sources):
+            if _BIG_ENDIAN:
+                arr = array.array("H", arr)
+                arr.byteswap()
+            buf += arr.tobytes()
+        buf += self._kinds
+        return bytes(buf)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        try:
+            digest, count = _HEADER.unpack_from(buf)
+        except struct.error:
+            raise ValueError("xref index too short")
+        pos = _HEADER.size
+        if len(buf) != pos + 5 * count: raise ValueError("xref index size mismatch")
+
+        arrays = []
+        for _ in range(2):
+            arr = array.array("H")
+            arr.frombytes(bytes(buf[pos:pos+2*count]))
+            if _BIG_ENDIAN: arr.byteswap()
+            arrays.append(arr)
+            pos += 2 * count
+        kinds = bytes(buf[pos:pos+count])
+
+        return cls(digest, arrays[0], arrays[1], kinds)
+
+
+def bank_digest(bank):
+    """bank の origin, サイズ, 内容のダイジェスト。"""
+    h = hashlib.sha1(util.pack_u(bank.org, 2))
+    h.update(util.pack_u(len(bank), 4))
+    h.update(bank.view())
+    return h.digest()
+
+def _walk(dis, db, bank, lo, hi):
+    """行の先頭 lo から hi までの命令の (参照先, 参照元, 種別) のリスト。"""
+    dec = bank.decode()
+    end = bank.addr_max() + 1
+
+    refs = []
+    addr = lo
+    while addr < hi:
+        if dis._is_code(db, dec, addr):
+            access = _OP_ACCESS[dec.opcode(addr)]
+            if access:
+                operand = dec.operand(addr)
+                if access & _BRANCH:
+                    operand = util.rel_target(addr, operand)
+                refs.append((db.get_operand_base(addr, operand), addr, access))
+            addr += dec.size(addr)
+        else:
+            data_size = db.get_data_type(addr).size
+            if addr + data_size > end:
+                data_size = 1
+            addr += data_size
+    return refs
+
+
+# バンクのダイジェスト, 参照数
+_HEADER = struct.Struct("<20sI")
+
+_BIG_ENDIAN = struct.pack("=H", 1) != struct.pack("<H", 1)
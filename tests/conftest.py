@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""テスト共通のフィクスチャ。"""
+
+
+import random
+
+import pytest
+
+from td6502 import Bank, PermissionMap
+from td6502.op import Op
+from td6502.db import Database, Analysis, DataType
+from td6502.ana import Analyzer
+
+
+_ORG  = 0x8000
+_SIZE = 0x1000
+
+_OFFICIAL = tuple(code for code in range(0x100) if Op.get(code).official)
+
+
+def _random_bank(rnd):
+    body = bytearray()
+    while len(body) < _SIZE:
+        if rnd.random() < 0.1:
+            body.append(rnd.getrandbits(8))
+            continue
+        op = Op.get(rnd.choice(_OFFICIAL))
+        body.append(op.code)
+        if op.argsize == 1:
+            body.append(rnd.getrandbits(8))
+        elif op.argsize == 2:
+            addr = rnd.randrange(_ORG, _ORG + _SIZE) if rnd.random() < 0.7 else rnd.getrandbits(16)
+            body += bytes((addr & 0xFF, addr >> 8))
+    return Bank(bytes(body[:_SIZE]), _ORG)
+
+@pytest.fixture
+def random_bank():
+    """rnd (random.Random) から合成バンクを作る関数。
+
+    公式命令を並べ、絶対アドレスの多くがバンク内を指すようにしたもの
+    (ところどころランダムなバイトを混ぜる)。
+    """
+    return _random_bank
+
+
+def _edit_stream(seed, count=20):
+    rnd  = random.Random(seed)
+    bank = _random_bank(rnd)
+    db   = Database(bank.org)
+    ops_valid = [Op.get(code).official for code in range(0x100)]
+    Analyzer(vectorize=False).analyze(db, bank, ops_valid, PermissionMap(), bank.org)
+    return bank, db, _edits(rnd, db, bank, count)
+
+def _edits(rnd, db, bank, count):
+    end = bank.addr_max() + 1
+    for _ in range(count):
+        addrs = set()
+        for _ in range(rnd.choice((1, 1, 2, 5))):
+            addr = rnd.randrange(bank.org, end)
+            if rnd.random() < 0.2:
+                type_ = rnd.choice(tuple(DataType))
+                db.set_data_type(addr, type_)
+                addrs.update(range(addr, addr + type_.size))
+            else:
+                size = min(rnd.choice((1, 1, 3, 0x40)), end - addr)
+                db.set_analysis(addr, rnd.choice(tuple(Analysis)), size)
+                addrs.update(range(addr, addr + size))
+        yield addrs
+
+@pytest.fixture
+def edit_stream():
+    """seed から (bank, db, edits) を作る関数。
+
+    bank は random_bank() と同様の合成バンク、db はそれを解析したもの。
+    edits は db に解析結果またはデータ型の変更を count 回加えるイテレー
+    タで、その都度変更したアドレスの集合を返す。
+    """
+    return _edit_stream
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Analyzer の pass 1 の NumPy 版と純 Python 版が同じ結果になることの確認。"""
+
+
+import io
+import random
+
+import pytest
+
+from td6502 import Bank, PermissionMap
+from td6502.op import Op
+from td6502.db import Database, Analysis
+from td6502.ana import Analyzer
+from td6502 import ana
+
+
+pytestmark = pytest.mark.skipif(ana._ana_numpy is None or not ana._ana_numpy.SUPPORTED,
+                                reason="NumPy not available")
+
+
+# 分岐、インデックス付き、BRK, JMP, KIL などを多めに含むバイト列
+_OPCODES_DENSE = (0x10, 0xFC, 0x30, 0x00, 0x20, 0x4C, 0x6C, 0x1D, 0x15, 0x11, 0x02)
+
+def _random_case(seed):
+    rnd = random.Random(seed)
+
+    size = rnd.choice((0x10, 0x100, 0x1000, 0x4000))
+    org  = rnd.choice((0x8000, 0x10000 - size, 0x0000, 0x7F80))
+    org  = min(org, 0x10000 - size)
+
+    kind = seed % 3
+    if kind == 0:
+        body = bytes(rnd.getrandbits(8) for _ in range(size))
+    elif kind == 1:
+        body = bytes(rnd.choice(_OPCODES_DENSE + (rnd.getrandbits(8),)) for _ in range(size))
+    else:
+        body = bytes(rnd.choice((0x10, 0xFC, 0xFA, 0xF0)) for _ in range(size))
+
+    perms = PermissionMap()
+    for _ in range(rnd.randrange(10)):
+        lo = rnd.randrange(0x10000)
+        hi = min(0xFFFF, lo + rnd.randrange(0x800))
+        perms.set_range(lo, hi, **{ rnd.choice(("readable", "writable", "executable")) : False })
+
+    hints = [(rnd.randrange(0x10000), rnd.choice((Analysis.CODE, Analysis.NOTCODE)))
+             for _ in range(rnd.randrange(50))]
+    ops_valid = [Op.get(code).official or rnd.random() < 0.5 for code in range(0x100)]
+    irq = rnd.choice((None, org, org + size//2, 0x0000))
+
+    return body, org, perms, hints, ops_valid, irq
+
+def _analyze(vectorize, body, org, perms, hints, ops_valid, irq):
+    db = Database(org)
+    for addr, analysis in hints:
+        db.set_analysis(addr, analysis)
+
+    analyzer = Analyzer(vectorize=vectorize)
+    assert analyzer.vectorize == vectorize
+    analyzer.analyze(db, Bank(body, org), ops_valid, perms, irq)
+
+    out = io.StringIO()
+    db.save_script(out)
+    return bytes(db.analysis), out.getvalue()
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_vectorize_same_result(seed):
+    case = _random_case(seed)
+    assert _analyze(True, *case) == _analyze(False, *case)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""BoundaryIndex.update() の結果が、build() し直したものと一致すること
+の確認。
+"""
+
+
+import pytest
+
+from td6502.dis import MD6502Dis, BoundaryIndex
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_boundary_update(seed, edit_stream):
+    bank, db, edits = edit_stream(seed)
+
+    dis   = MD6502Dis()
+    index = BoundaryIndex.build(dis, db, bank)
+    for addrs in edits:
+        old    = bytes(index.states)
+        ranges = index.update(dis, db, bank, addrs)
+
+        ref = BoundaryIndex.build(dis, db, bank)
+        assert index.states == ref.states
+
+        # 状態の変わったアドレスは返された範囲に含まれる
+        changed = [bank.org + i for i in range(len(bank)) if old[i] != ref.states[i]]
+        assert all(any(lo <= addr < hi for lo, hi in ranges) for addr in changed)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""Analyzer.reanalyze() の結果が、変更を加えた初期状態からの analyze()
+と一致することの確認。
+"""
+
+
+import random
+
+import pytest
+
+from td6502 import PermissionMap
+from td6502.op import Op
+from td6502.db import Database, Analysis
+from td6502.ana import Analyzer
+
+
+def _random_perms(rnd):
+    perms = PermissionMap()
+    for _ in range(rnd.randrange(4)):
+        lo = rnd.randrange(0x10000)
+        hi = min(0xFFFF, lo + rnd.randrange(0x400))
+        perms.set_range(lo, hi, **{ rnd.choice(("readable", "writable", "executable")) : False })
+    return perms
+
+def _random_edit(rnd, db, bank, serial):
+    k = rnd.random()
+    addr = rnd.randrange(bank.org - 16, bank.addr_max() + 1 + 16)
+    if k < 0.35:
+        return ("notcode", addr, rnd.choice((1, 1, 3)))
+    elif k < 0.7:
+        return ("code", addr, 1)
+    elif k < 0.8:
+        return ("unknown", addr, 1)
+    elif k < 0.9 or not db.labels():
+        return ("label", "U_{:04X}_{}".format(addr, serial), addr, rnd.choice((1, 1, 4)))
+    else:
+        return ("remove_label", rnd.choice([label.name for label in db.labels()]))
+
+def _apply(db, edit, lenient=False):
+    kind = edit[0]
+    if kind == "notcode":
+        db.set_analysis(edit[1], Analysis.NOTCODE, edit[2])
+    elif kind == "code":
+        db.set_analysis(edit[1], Analysis.CODE)
+    elif kind == "unknown":
+        db.set_analysis(edit[1], Analysis.UNKNOWN)
+    elif kind == "label":
+        db.add_label(edit[1], edit[2], edit[3])
+    elif kind == "remove_label":
+        try:
+            db.remove_label(edit[1])
+        except KeyError:
+            # 自動で振られたラベルの場合、初期状態にはない
+            if not lenient: raise
+
+def _labels(db):
+    return sorted((label.name, label.addr, label.size) for label in db.labels())
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_reanalyze_same_as_full(seed, random_bank):
+    rnd = random.Random(seed)
+
+    bank      = random_bank(rnd)
+    perms     = _random_perms(rnd)
+    ops_valid = [Op.get(code).official for code in range(0x100)]
+    irq       = rnd.choice((None, bank.org, bank.org + rnd.randrange(len(bank))))
+
+    db = Database(bank.org)
+    analyzer = Analyzer(vectorize=rnd.random() < 0.5)
+    analyzer.analyze(db, bank, ops_valid, perms, irq)
+    db.start_journal()
+
+    edits = []
+    for _ in range(12):
+        for _ in range(rnd.choice((1, 1, 1, 2, 5))):
+            edit = _random_edit(rnd, db, bank, len(edits))
+            edits.append(edit)
+            _apply(db, edit)
+        analyzer.reanalyze(db, bank, db.take_journal())
+
+        ref = Database(bank.org)
+        for edit in edits:
+            _apply(ref, edit, lenient=True)
+        Analyzer(vectorize=False).analyze(ref, bank, ops_valid, perms, irq)
+
+        assert bytes(db.analysis) == bytes(ref.analysis)
+        assert _labels(db) == _labels(ref)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""XrefIndex の差分更新と、古いインデックスが使われないことの確認。"""
+
+
+import random
+
+import pytest
+
+from td6502 import Bank, PermissionMap
+from td6502.op import Op
+from td6502.db import Database, DataType
+from td6502.ana import Analyzer
+from td6502.dis import MD6502Dis, BoundaryIndex
+from td6502.xref import XrefIndex
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_xref_update(seed, edit_stream):
+    """td6502-server と同様に、行境界インデックスの更新範囲から相互参照
+    を差分更新する。
+    """
+    bank, db, edits = edit_stream(seed)
+
+    dis   = MD6502Dis()
+    index = BoundaryIndex.build(dis, db, bank)
+    xrefs = XrefIndex.build(dis, db, bank)
+    assert len(xrefs) > 0
+
+    for addrs in edits:
+        xrefs = xrefs.update(dis, db, bank, index.update(dis, db, bank, addrs))
+        assert xrefs.to_bytes() == XrefIndex.build(dis, db, bank).to_bytes()
+
+
+def test_stale_index(random_bank):
+    bank = random_bank(random.Random(0))
+    db   = Database(bank.org)
+    ops_valid = [Op.get(code).official for code in range(0x100)]
+    Analyzer(vectorize=False).analyze(db, bank, ops_valid, PermissionMap(), bank.org)
+
+    dis   = MD6502Dis()
+    xrefs = dis.xrefs(db, bank)
+    assert dis.xrefs(db, bank) is xrefs
+    assert XrefIndex.from_bytes(xrefs.to_bytes()).matches(bank)
+
+    # 同じ origin, サイズの別のバンク
+    other = Bank(bytes(reversed(bank.view())), bank.org)
+    assert not xrefs.matches(other)
+    assert dis.xrefs(db, other) is not xrefs
+
+    # オペランドの指定や解析結果の変更で破棄される
+    for change in (lambda: db.set_operand_disp(bank.org, 1),
+                   lambda: db.set_operand_label(bank.org, "foo"),
+                   lambda: db.set_analysis(bank.org, db.get_analysis(bank.org))):
+        dis.xrefs(db, bank)
+        change()
+        assert db.xrefs is None
+
+    # データ型の変更: 参照元の命令が WORD データになると参照も消える
+    target, src, _ = dis.xrefs(db, bank).refs_to_range(0, 0x10000)[0]
+    db.set_data_type(src, DataType.WORD)
+    assert db.xrefs is None
+    assert src not in [ref[1] for ref in dis.xrefs(db, bank).refs_to_range(target, 1)]